@@ -2,8 +2,24 @@ import json
 import logging
 import lxml
 from google.appengine.api import memcache
-from models import Movie, Artist, TasteMovie, TasteArtist, TasteGenre
-from utilities import get, RetrieverError, BASE_URL_MYAPIFILMS, GENRES, clear_url
+from models import Movie, Artist, MovieTitle, WriteBatch
+from utilities import get, get_parsed, RetrieverError, BASE_URL_MYAPIFILMS, GENRES, clear_url
+
+
+def get_italian_plot(html_page):
+    """
+    Parse the FilmTV page of a movie and retrieve its italian plot.
+    :param html_page: HTML page to parse
+    :type html_page: string
+    :return: plot or None if not found
+    :rtype: unicode
+    """
+    tree = lxml.html.fromstring(html_page.encode('utf-8'))
+    try:
+        return unicode(tree.xpath('//article[@class="scheda-desc"]/p/text()')[0])
+    except IndexError:
+        logging.error('Impossible to retrieve info from FilmTV')
+        return None
 
 
 def retrieve_movie_from_title(movie_original_title, movie_director, movie_cast, movie_title=None, movie_url=None,
@@ -30,6 +46,8 @@ def retrieve_movie_from_title(movie_original_title, movie_director, movie_cast,
     json_page = get(url).encode('utf-8')
     json_data = json.loads(json_page)
 
+    batch = WriteBatch()  # Collect all the writes of the movie
+
     if type(json_data) is not list:  # If it is not a list there is a problem
         logging.info('Movie not found in IMDB.')
         for x in range(26, len(movie_url)):
@@ -57,19 +75,12 @@ def retrieve_movie_from_title(movie_original_title, movie_director, movie_cast,
             if i == "," or count == len(actors_string) - 1:
                 actors_list.append(actors_string[begin:count - 1])
                 begin = count + 1
-                search_artist_from_name(actors_list[len(actors_list) - 1], movie)
+                search_artist_from_name(actors_list[len(actors_list) - 1], movie, batch=batch)
 
         for director_name in directors_list:
-            search_artist_from_name(actors_list[len(actors_list) - 1], movie, director_name)
-
-        html_page_plot = get(movie_url).encode('utf-8')
-        tree = lxml.html.fromstring(html_page_plot)
-        try:
-            movie.plot_it = tree.xpath('//article[@class="scheda-desc"]/p/text()')[0]
-        except IndexError:
-            logging.error('Impossible to retrieve info from FilmTV')
-            pass
-        movie.put()
+            search_artist_from_name(actors_list[len(actors_list) - 1], movie, director_name, batch)
+
+        movie.plot_it = get_parsed(movie_url, get_italian_plot)  # Parsed only if changed
     else:
         directors_list = json_data[0]['directors']
         #print movie_director
@@ -105,19 +116,11 @@ def retrieve_movie_from_title(movie_original_title, movie_director, movie_cast,
             actors_list = json_data[0]['actors']
             writers_list = json_data[0]['writers']
 
-            retrieve_artists(movie, actors_list, directors_list, writers_list)
+            retrieve_artists(movie, actors_list, directors_list, writers_list, batch)
 
             logging.info('Url FilmTV: %s', movie_url)
 
-            html_page_plot = get(movie_url).encode('utf-8')
-            tree = lxml.html.fromstring(html_page_plot)
-            try:
-                movie.plot_it = tree.xpath('//article[@class="scheda-desc"]/p/text()')[0]
-
-            except IndexError:
-                logging.error('Impossible to retrieve info from FilmTV')
-                pass
-            movie.put()
+            movie.plot_it = get_parsed(movie_url, get_italian_plot)  # Parsed only if changed
         else:
             logging.info("FilmTV movie is not the same with retrieved movie in IMDB!")
             for x in range(26, len(movie_url)):
@@ -147,20 +150,17 @@ def retrieve_movie_from_title(movie_original_title, movie_director, movie_cast,
                     if i == "," or count == len(actors_string) - 1:
                         actors_list.append(actors_string[begin:count - 1])
                         begin = count + 1
-                        search_artist_from_name(actors_list[len(actors_list) - 1], movie)
+                        search_artist_from_name(actors_list[len(actors_list) - 1], movie, batch=batch)
             if directors_list is not None:
                 for director_name in directors_list:
-                    search_artist_from_name(actors_list[len(actors_list) - 1], movie, director_name)
+                    search_artist_from_name(actors_list[len(actors_list) - 1], movie, director_name, batch)
 
-            html_page_plot = get(movie_url).encode('utf-8')
-            tree = lxml.html.fromstring(html_page_plot)
-            try:
-                movie.plot_it = tree.xpath('//article[@class="scheda-desc"]/p/text()')[0]
-            except IndexError:
-                logging.error('Impossible to retrieve info from FilmTV')
-                pass
+            movie.plot_it = get_parsed(movie_url, get_italian_plot)  # Parsed only if changed
 
-    key = movie.put()
+    key = batch.add(movie)
+    for movie_title_entry in MovieTitle.index_movie(movie):  # Index the titles used by FilmTV
+        batch.add(movie_title_entry)
+    batch.flush()  # Store the movie and its artists together
     logging.info('Retrieved %s', movie_original_title)
 
     return key
@@ -213,18 +213,22 @@ def retrieve_movie_from_id(movie_id):
         year = year[-4:]
 
     movie.year = year
-    key = movie.put()
     actors_list = json_data['actors']
     directors_list = json_data['directors']
     writers_list = json_data['writers']
 
-    retrieve_artists(movie, actors_list, directors_list, writers_list)
+    batch = WriteBatch()  # Collect all the writes of the movie
+    key = batch.add(movie)
+    retrieve_artists(movie, actors_list, directors_list, writers_list, batch)
+    for movie_title_entry in MovieTitle.index_movie(movie):
+        batch.add(movie_title_entry)
+    batch.flush()  # Store the movie and its artists together
 
     logging.info('Retrieved %s', movie_id)
     return key
 
 
-def retrieve_artists(movie, actors_list, directors_list, writers_list):
+def retrieve_artists(movie, actors_list, directors_list, writers_list, batch=None):
     """
     Retrieve all artist in a movie from actors, directors and writers lists.
     :param movie: Movie object in order to add actors, directors and writers
@@ -235,32 +239,44 @@ def retrieve_artists(movie, actors_list, directors_list, writers_list):
     :type directors_list: list of dict
     :param writers_list: list of writers
     :type writers_list: list of dict
+    :param batch: batch in which collect the writes, if None artists and movie are stored at the end of the function
+    :type batch: WriteBatch
     """
+    own_batch = batch is None
+    if own_batch:
+        batch = WriteBatch()
+
     for json_data in actors_list:
         actor = Artist(id=json_data['actorId'],
                        name=json_data['actorName'],
                        photo=clear_url(json_data['urlPhoto']))
-        actor.put()
-        movie.add_actor(actor)
+        batch.add(actor)
+        movie.add_actor(actor, batch)
 
     for json_data in directors_list:
         director = Artist(id=json_data['nameId'],
                           name=json_data['name'])
-        director.put()
-        movie.add_director(director)
+        batch.add(director)
+        movie.add_director(director, batch)
 
     for json_data in writers_list:
         writer = Artist(id=json_data['nameId'],
                         name=json_data['name'])
-        writer.put()
-        movie.add_writer(writer)
+        batch.add(writer)
+        movie.add_writer(writer, batch)
+
+    if own_batch:
+        batch.add(movie)
+        batch.flush()
 
 
-def search_artist_from_name(artist_name, movie=None, director_name=None):
+def search_artist_from_name(artist_name, movie=None, director_name=None, batch=None):
     """
     Retrieve artist info from IMDB by name of artist.
     :param artist_name: name of the actor to retrieve info
     :type artist_name: string
+    :param batch: batch in which collect the writes, if None the artist is stored immediately
+    :type batch: WriteBatch
     :return: Actor's key
     :rtype: ndb.Key
     :raise RetrieverError: if there is an error from MYAPIFILMS
@@ -284,9 +300,12 @@ def search_artist_from_name(artist_name, movie=None, director_name=None):
 
     if movie is not None:
         if director_name is not None:
-            movie.add_director(artist)
+            movie.add_director(artist, batch)
         else:
-            movie.add_actor(artist)
+            movie.add_actor(artist, batch)
+
+    if batch is not None:
+        return batch.add(artist)
 
     return artist.put()
 
@@ -338,7 +357,7 @@ def retrieve_suggest_list(user, query):
                     if elem['q'] == "feature":
                         try:
                             idIMDB = elem['id']
-                            taste_movie = TasteMovie.get_by_id(idIMDB + user.key.id())  # Get taste
+                            taste_movie = user.tastes.get("movie", idIMDB)  # Get taste
                             movies.append({"originalTitle": elem['l'].encode('utf-8') if elem['l'] is not None else None,
                                            "title": None,
                                            "idIMDB": idIMDB,
@@ -350,7 +369,7 @@ def retrieve_suggest_list(user, query):
                 else:
                     try:
                         idIMDB = elem['id']
-                        taste_artist = TasteArtist.get_by_id(idIMDB + user.key.id())
+                        taste_artist = user.tastes.get("artist", idIMDB)
                         artists.append({"name": elem['l'].encode('utf-8') if elem['l'] is not None else None,
                                         "idIMDB": elem['id'],
                                         "photo": clear_url(elem['i'][0]) if 'i' in elem else 'null',
@@ -362,7 +381,7 @@ def retrieve_suggest_list(user, query):
     except ValueError:
         pass
 
-    [genres.append({"name": genre, "tasted": 1 if (TasteGenre.get_by_id(genre + user.key.id()) is not None and (TasteGenre.get_by_id(genre + user.key.id())).added) else 0}) for genre in GENRES if genre.lower().startswith(query.lower())]
+    [genres.append({"name": genre, "tasted": 1 if (user.tastes.get("genre", genre) is not None and user.tastes.get("genre", genre).added) else 0}) for genre in GENRES if genre.lower().startswith(query.lower())]
 
     return {"query": query, "movies": movies, "artists": artists, "genres": genres}
 
@@ -390,7 +409,7 @@ def retrieve_search_result_list(user, query):
 
             for elem in json_data:
                 idIMDB = elem['idIMDB']
-                taste_movie = TasteMovie.get_by_id(idIMDB + user.key.id())  # Get taste
+                taste_movie = user.tastes.get("movie", idIMDB)  # Get taste
                 movies.append({"title": elem['title'].encode('utf-8') if elem['title'] != "" else elem['originalTitle'].encode('utf-8'),
                                "originalTitle": elem['originalTitle'].encode('utf-8') if elem['originalTitle'] != "" else elem['title'].encode('utf-8'),
                                "idIMDB": idIMDB,
@@ -407,7 +426,7 @@ def retrieve_search_result_list(user, query):
 
             for elem in json_data:
                 idIMDB = elem['idIMDB']
-                taste_artist = TasteArtist.get_by_id(idIMDB + user.key.id())
+                taste_artist = user.tastes.get("artist", idIMDB)
                 artists.append({"name": elem['name'].encode('utf-8') if elem['name'] != "" else None,
                                 "idIMDB": idIMDB,
                                 "photo": clear_url(elem['urlPhoto']) if ('urlPhoto' in elem and elem['urlPhoto'] != "") else None,
@@ -415,7 +434,7 @@ def retrieve_search_result_list(user, query):
     except ValueError:
         pass
 
-    [genres.append({"name": genre, "tasted": 1 if (TasteGenre.get_by_id(genre + user.key.id()) is not None and (TasteGenre.get_by_id(genre + user.key.id())).added) else 0}) for genre in GENRES if genre.lower().startswith(query)]
+    [genres.append({"name": genre, "tasted": 1 if (user.tastes.get("genre", genre) is not None and user.tastes.get("genre", genre).added) else 0}) for genre in GENRES if genre.lower().startswith(query)]
 
     return {"query": query, "movies": movies, "artists": artists, "genres": genres}
 
@@ -2,7 +2,6 @@ from datetime import datetime
 from flask import jsonify, request
 import logging
 import re
-from google.appengine.api import taskqueue
 
 from werkzeug.exceptions import BadRequest, MethodNotAllowed, InternalServerError
 from IMDB_retriever import retrieve_movie_from_id, retrieve_artist_from_id, retrieve_suggest_list, \
@@ -11,35 +10,87 @@ from gcm import GCM
 from google.appengine.ext import ndb
 from main import json_api
 from manage_user import User
-from models import Artist, Movie, TasteArtist, TasteMovie, TasteGenre
+from models import Artist, Movie, add_task, coalesce_writes
 from models import User as modelUser
-from movie_selector import taste_based_movie_selection
-from tv_scheduling import result_movies_schedule, result_movies_schedule_list
-from utilities import RetrieverError, GENRES, clear_url, channel_number
+from movie_selector import ScheduleFeatures, build_proposal, count_rankable, get_proposal, proposal_scores
+from tv_scheduling import result_movies_schedule, query_movies_schedule, schedule_minutes
+from utilities import RetrieverError, GENRES, NUMBER_SUGGESTIONS, TV_TYPE, clear_url
 
-app = json_api(__name__)
+app = coalesce_writes(json_api(__name__))
 app.config['DEBUG'] = True
 
 
 @app.route('/api/schedule/<tv_type>/<day>', methods=['GET'])
 def schedule(tv_type, day):
     """
-    Returns a JSON containing the TV programming of <tv_type> in the <day>.
+    Returns a JSON containing the TV programming of <tv_type> in the <day>, only the movies from ?from= to ?to= (as
+    HH:MM) and on ?channel= (number or name) if asked.
     :param tv_type: type of TV from get schedule, possible value (free, sky, premium)
     :type tv_type: string
     :param day: interested day, possible value (today, tomorrow, future)
     :type day: string
     :return: schedule
-        {"code": 0, "data": {"day": day, "schedule": [{"channel": channel_name, "movieUrl": url,
-        "originalTitle": original_title, "time": time, "title": title}, .. ], "type": tv_type}}
+        {"code": 0, "data": {"day": day, "schedule": [{"channel": channel_name, "channelNumber": channel_number,
+        "minutes": minutes, "movieUrl": url, "originalTitle": original_title, "time": time, "title": title}, .. ],
+        "type": tv_type}}
     :rtype: JSON
+    :raise BadRequest: if from or to are not valid
     """
     if request.method == 'GET':
-        return jsonify(code=0, data={"type": tv_type, "day": day, "schedule": result_movies_schedule(tv_type, day)})
+        if any(arg in request.args for arg in ('from', 'to', 'channel')):
+            start, end, channel = schedule_filters()
+            movies = query_movies_schedule([tv_type], day, start, end, channel)
+        else:
+            movies = result_movies_schedule(tv_type, day)
+        return jsonify(code=0, data={"type": tv_type, "day": day, "schedule": movies})
     else:
         raise MethodNotAllowed
 
 
+@app.route('/api/schedule/<day>', methods=['GET'])
+def schedule_query(day):
+    """
+    Returns a JSON containing the TV programming of the tv types ?types= (separated by comma, default free) in the
+    <day>, merged by time. Only the movies from ?from= to ?to= (as HH:MM) and on ?channel= (number or name) if asked.
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :return: schedule
+        {"code": 0, "data": {"day": day, "schedule": [{"channel": channel_name, "channelNumber": channel_number,
+        "minutes": minutes, "movieUrl": url, "originalTitle": original_title, "time": time, "title": title,
+        "type": tv_type}, .. ], "types": [tv_type]}}
+    :rtype: JSON
+    :raise BadRequest: if the types, from or to are not valid
+    """
+    if request.method == 'GET':
+        tv_type_list = request.args.get('types', TV_TYPE[0]).lower().split(',')
+        if any(tv_type not in TV_TYPE for tv_type in tv_type_list):
+            raise BadRequest
+
+        start, end, channel = schedule_filters()
+        return jsonify(code=0, data={"types": tv_type_list, "day": day,
+                                     "schedule": query_movies_schedule(tv_type_list, day, start, end, channel)})
+    else:
+        raise MethodNotAllowed
+
+
+def schedule_filters():
+    """
+    Return the filters of the schedule asked with ?from=, ?to= and ?channel=.
+    :return: first and last minute of the window, see schedule_minutes, and channel, None if not asked
+    :rtype: tuple
+    :raise BadRequest: if from or to are not valid
+    """
+    window = []
+    for arg in ('from', 'to'):
+        value = request.args.get(arg)
+        minutes = schedule_minutes(value) if value is not None else None
+        if value is not None and minutes is None:
+            raise BadRequest
+        window.append(minutes)
+
+    return window[0], window[1], request.args.get('channel')
+
+
 @app.route('/api/tastes/<user_id>/<type>', methods=['GET', 'POST'])
 def tastes(user_id, type):
   """
@@ -78,7 +129,7 @@ def tastes(user_id, type):
                 artist = get_or_retrieve_by_id(id_imdb)  # Get or retrieve artist
                 modify_Json(user, artist, "artist")
                 user.add_taste_artist(artist)  # Add artist to tastes
-                taskqueue.add(url='/api/proposal/' + user.key.id(), method='GET')
+                add_task(url='/api/proposal/' + user.key.id(), method='GET')
 
                 return jsonify(code=0) #get_tastes_artists_list(user)  # Return tastes
 
@@ -111,7 +162,7 @@ def tastes(user_id, type):
                 if genre in GENRES:
                     modify_Json(user, genre, "genre")
                 user.add_taste_genre(genre)  # Add genre to tastes
-                taskqueue.add(url='/api/proposal/' + user.key.id(), method='GET')
+                add_task(url='/api/proposal/' + user.key.id(), method='GET')
 
                 user.put()
                 return jsonify(code=0) #get_tastes_genres_list(user)  # Return tastes
@@ -258,7 +309,7 @@ def remove_taste(user_id, type, data):
 
                 delete_in_Json(user, artist, "artist")
                 user.remove_taste_artist(artist)  # Remove artist from tastes
-                taskqueue.add(url='/api/proposal/' + user.key.id(), method='GET')
+                add_task(url='/api/proposal/' + user.key.id(), method='GET')
 
                 return jsonify(code=0)
 
@@ -274,7 +325,7 @@ def remove_taste(user_id, type, data):
                 if data in GENRES:
                     delete_in_Json(user, data, "genre")
                     user.remove_taste_genre(data)  # Remove genre from tastes
-                    taskqueue.add(url='/api/proposal/' + user.key.id(), method='GET')
+                    add_task(url='/api/proposal/' + user.key.id(), method='GET')
                     return jsonify(code=0)
 
                 else:
@@ -397,10 +448,8 @@ def subscribe():
                            enableNotification=user.enable_notification, timeNotification=user.time_notification)
         else:
             logging.info("subrscribing user")
-            user.subscribe(name=json_data['userName'], birth_year=json_data['userBirthYear'],
-                           gender=json_data['userGender'], gcm_key=json_data['privateKey'])
-
-            user = modelUser.get_by_id(user_id)
+            user = user.subscribe(name=json_data['userName'], birth_year=json_data['userBirthYear'],
+                                  gender=json_data['userGender'], gcm_key=json_data['privateKey'])
 
             return jsonify(code=0, data={"userId": user_id, "message": "User subscribed successful!"},
                            repeatChoice=user.repeat_choice, tvType=user.tv_type,
@@ -436,53 +485,38 @@ def unsubscribe(user_id):
 @app.route('/api/proposal/<user_id>', methods=['GET'])
 def proposal(user_id):
     """
-    Return the movies proposal for the user.
+    Return a page of the movies proposal for the user, ?limit= movies (default NUMBER_SUGGESTIONS) from ?offset=
+    (default 0), for the schedule of ?day= (today, tomorrow or future, default today). The best movies are stored, the
+    others are ranked and rendered only when asked.
     :param user_id: email of the user
     :type user_id: string
     :return: list of proposal
         {"code": 0, "data": {"proposal": [{"channel": channel, "id_IMDB": id_IMDB, "original_title": original_title,
         "poster": poster, "simple_plot": simple_plot, "time": time}], "user_id": user_id}}
     :rtype: JSON
+    :raise BadRequest: if limit, offset or day are not valid
     """
     if request.method == 'GET':
+        day = request.args.get('day', 'today')
+        try:
+            limit = int(request.args.get('limit', NUMBER_SUGGESTIONS))
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            raise BadRequest
+        if limit < 0 or offset < 0:
+            raise BadRequest
 
         user = modelUser.get_by_id(user_id)  # Get user
 
         if user is not None:
-            proposals = user.proposal
-            if proposals is None:
-                proposals = []
-
-                tv_type_list = user.tv_type
-                movies = taste_based_movie_selection(user, result_movies_schedule_list(tv_type_list))
-
-                for movie in movies:
-                    logging.info("Scelto: %s", (
-                        str(movie[0]["originalTitle"]) if movie[0]["originalTitle"] is not None else str(
-                            movie[0]["title"])))
-
-                    movie_data_store = Movie.query(ndb.OR(Movie.original_title == movie[0]["originalTitle"],
-                                                          Movie.title == movie[0][
-                                                              "title"])).get()  # Find movie by title
-                    proposals.append({"idIMDB": movie_data_store.key.id(),
-                                      "originalTitle": movie[0]["originalTitle"] if movie[0][
-                                                                                        "originalTitle"] is not None else
-                                      movie[0]["title"],
-                                      "poster": movie_data_store.poster,
-                                      "title": movie[0]["title"] if movie[0]["title"] is not None else movie[0][
-                                          "originalTitle"],
-                                      "channel": movie[0]["channel"],
-                                      "channelNumber": channel_number(movie[0]["channel"]),
-                                      "time": movie[0]["time"],
-                                      "runTimes": movie_data_store.run_times,
-                                      "simplePlot": movie_data_store.simple_plot,
-                                      "italianPlot": movie_data_store.plot_it})
-
-                    if movie_data_store is not None:
-                        pass
-
-                user.proposal = proposals
-                user.put()
+            features = ScheduleFeatures.for_tv_types(user.tv_type, day)
+            proposal = get_proposal(user, features)  # Computed only if stale, usually the night before
+
+            asked = min(offset + limit, count_rankable(user, features))  # Ranks of the page in the schedule
+            if offset + limit <= len(proposal.movies) or asked <= NUMBER_SUGGESTIONS:
+                proposals = proposal.movies[offset:offset + limit]  # The stored proposal has the ranks of the page
+            else:  # Lower ranked movies
+                proposals = build_proposal(user, features, limit, offset, proposal_scores(user, features, proposal))
             return jsonify(code=0, data={"userId": user.key.id(), "proposal": proposals})
         else:
             raise InternalServerError(user_id + ' is not subscribed')
@@ -667,41 +701,80 @@ def get_or_retrieve_by_id(id_imdb):
         else:
             raise InternalServerError(id_imdb + " is not a valid IMDb id or film.TV id")
 
-# TODO: argument next functions
-def generate_artists(user, page=0):
+def get_tasted_artists(user, threshold=1, page=0):
+    """
+    Get the artists explicitly added by the user, retrieving them together.
+    :param user: user
+    :type user: Models.User
+    :param threshold: minimum taste of the artists
+    :type threshold: float
+    :param page: first taste to consider
+    :type page: int
+    :return: list of (artist id, artist)
+    :rtype: list of tuple
+    """
+    artists_id = [artist_id for artist_id, taste in user.tastes.items("artist")[page:]
+                  if taste.taste >= threshold and taste.added]
+    artists = ndb.get_multi([ndb.Key(Artist, artist_id) for artist_id in artists_id])  # Get all artists together
 
-    tastes_artists_id = user.tastes_artists  # Get all taste_artists' keys
-    artists = []
+    return [(artist_id, artist) for artist_id, artist in zip(artists_id, artists) if artist is not None]
 
-    for i in range(page, len(tastes_artists_id)):
-        taste_artist_id = tastes_artists_id[i]
-        taste_artist = TasteArtist.get_by_id(taste_artist_id.id())  # Get taste
 
-        if taste_artist.taste >= 1 and taste_artist.added:
+def get_tasted_movies(user, threshold=1, page=0, only_added=True):
+    """
+    Get the movies tasted by the user, retrieving them together.
+    :param user: user
+    :type user: Models.User
+    :param threshold: minimum taste of the movies
+    :type threshold: float
+    :param page: first taste to consider
+    :type page: int
+    :param only_added: True in order to get only the movies explicitly added
+    :type only_added: bool
+    :return: list of (movie id, movie)
+    :rtype: list of tuple
+    """
+    movies_id = [movie_id for movie_id, taste in user.tastes.items("movie")[page:]
+                 if not only_added or (taste.taste >= threshold and taste.added)]
+    movies = ndb.get_multi([ndb.Key(Movie, movie_id) for movie_id in movies_id])  # Get all movies together
 
-            artist_id = taste_artist.artist.id()  # Get artist id from taste
-            artist = Artist.get_by_id(artist_id)  # Get artist by id
+    return [(movie_id, movie) for movie_id, movie in zip(movies_id, movies) if movie is not None]
 
-            artists.append({"idIMDB": artist_id,
-                            "name": artist.name.encode('utf-8') if artist.name is not None else None,
-                            "tasted": 1,
-                            "photo": artist.photo})
+
+def get_tasted_genres(user, threshold=1.0, page=0):
+    """
+    Get the genres explicitly added by the user.
+    :param user: user
+    :type user: Models.User
+    :param threshold: minimum taste of the genres
+    :type threshold: float
+    :param page: first taste to consider
+    :type page: int
+    :return: list of genres
+    :rtype: list of string
+    """
+    return [genre for genre, taste in user.tastes.items("genre")[page:] if taste.taste >= threshold and taste.added]
+
+
+# TODO: argument next functions
+def generate_artists(user, page=0):
+
+    artists = []
+
+    for artist_id, artist in get_tasted_artists(user, page=page):
+        artists.append({"idIMDB": artist_id,
+                        "name": artist.name.encode('utf-8') if artist.name is not None else None,
+                        "tasted": 1,
+                        "photo": artist.photo})
 
     return artists
 
 
 def generate_movies(user, page=0):
 
-    tastes_movies_id = user.tastes_movies
     movies = []
 
-    for i in range(page, len(tastes_movies_id)):
-        taste_movie_id = tastes_movies_id[i]
-        taste_movie = TasteMovie.get_by_id(taste_movie_id.id())  # Get taste
-
-        movie_id = taste_movie.movie.id()  # Get movie id from taste
-        movie = Movie.get_by_id(movie_id)  # Get movie by id
-
+    for movie_id, movie in get_tasted_movies(user, page=page, only_added=False):
         movies.append({"idIMDB": movie_id,
                        "originalTitle": movie.original_title.encode('utf-8') if movie.original_title is not None else movie.title.encode('utf-8'),
                        "title": movie.title.encode('utf-8') if movie.title is not None else movie.original_title.encode('utf-8'),
@@ -713,18 +786,11 @@ def generate_movies(user, page=0):
 
 def generate_genres(user, page=0):
 
-    tastes_genres_id = user.tastes_genres
     genres = []
 
-    for i in range(page, len(tastes_genres_id)):
-        taste_genre_id = tastes_genres_id[i]
-        taste_genre = TasteGenre.get_by_id(taste_genre_id.id())  # Get taste
-
-        # TODO: not use object, use a simple list
-        if taste_genre.taste >= 1.0 and taste_genre.added:
-
-            genres.append({"name": taste_genre.genre,
-                           "tasted": 1})
+    for genre in get_tasted_genres(user, page=page):
+        genres.append({"name": genre,
+                       "tasted": 1})
 
     return genres
 
@@ -761,13 +827,14 @@ def get_watched_movies_list(user, page=0):
     else:
         prev_page_url = None
 
+    watched_movies = ndb.get_multi(watched_movies_id[page * 10:last_elem])  # Get all movies of the page together
+
     for i in range(page * 10, last_elem):  # Preparing JSON with list of movies watched for current page
-        watched_movie_id = watched_movies_id[i].id()
-        watched_movie = Movie.get_by_id(watched_movie_id)  # Get movie
+        watched_movie = watched_movies[i - page * 10]  # Get movie
 
         date_watched_movie = user.date_watched[i]  # Get date
 
-        taste_movie = TasteMovie.get_by_id(watched_movie_id + user.key.id())  # Get taste
+        taste_movie = user.tastes.get("movie", watched_movie.key.id())  # Get taste
 
         movies.append({"idIMDB": watched_movie.key.id(),
                        "originalTitle": watched_movie.original_title.encode('utf-8') if watched_movie.original_title is not None else watched_movie.title.encode('utf-8'),
@@ -790,21 +857,13 @@ def get_tastes_artists_list(user, page=0):
         "type": type, "userId": user_id}
     :rtype: JSON
     """
-    tastes_artists_id = user.tastes_artists  # Get all taste_artists' keys
-
     artists = []
 
-    for taste_artist_id in tastes_artists_id:
-        taste_artist = TasteArtist.get_by_id(taste_artist_id.id())  # Get taste
-
-        if taste_artist.taste >= 1 and taste_artist.added:
-            artist_id = taste_artist.artist.id()  # Get artist id from taste
-            artist = Artist.get_by_id(artist_id)  # Get artist by id
-
-            artists.append({"idIMDB": artist_id,
-                            "name": artist.name.encode('utf-8') if artist.name is not None else None,
-                            "tasted": 1,
-                            "photo": artist.photo})
+    for artist_id, artist in get_tasted_artists(user):
+        artists.append({"idIMDB": artist_id,
+                        "name": artist.name.encode('utf-8') if artist.name is not None else None,
+                        "tasted": 1,
+                        "photo": artist.photo})
 
     return jsonify(code=0, data={"userId": user.key.id(), "type": "artist", "tastes": artists})
 
@@ -819,17 +878,10 @@ def get_tastes_movies_list(user, page=0):
         "type": type, "userId": user_id}
     :rtype: JSON
     """
-    tastes_movies_id = user.tastes_movies
-
     movies = []
 
-    for taste_movie_id in tastes_movies_id:
-        taste_movie = TasteMovie.get_by_id(taste_movie_id.id())  # Get taste
-        if taste_movie.taste >= 1 and taste_movie.added:
-            movie_id = taste_movie.movie.id()  # Get movie id from taste
-            movie = Movie.get_by_id(movie_id)  # Get movie by id
-
-            movies.append({"idIMDB": movie_id,
+    for movie_id, movie in get_tasted_movies(user):
+        movies.append({"idIMDB": movie_id,
                        "originalTitle": movie.original_title.encode('utf-8') if movie.original_title is not None else None,
                        "title": movie.title.encode('utf-8') if movie.title is not None else None,
                        "tasted": 1,
@@ -848,17 +900,12 @@ def get_tastes_genres_list(user, page=0):
         "type": type, "userId": user_id}
     :rtype: JSON
     """
-    tastes_genres_id = user.tastes_genres
-
     genres = []
 
-    for taste_genre_id in tastes_genres_id:
-        taste_genre = TasteGenre.get_by_id(taste_genre_id.id())  # Get taste
-
-        # TODO: not use object, use a simple list
-        if taste_genre.taste >= 0.99 and taste_genre.added:
-            genres.append({"name": taste_genre.genre,
-                           "tasted": 1})
+    # TODO: not use object, use a simple list
+    for genre in get_tasted_genres(user, 0.99):
+        genres.append({"name": genre,
+                       "tasted": 1})
 
     return jsonify(code=0, data={"userId": user.key.id(), "type": "genre", "tastes": genres})
 
@@ -881,59 +928,29 @@ def get_tastes_list(user):
 
     logging.info("rebuiling tastes")
 
-    tastes_artists_id = user.tastes_artists  # Get all taste_artists' keys
     artists = []
 
-    for taste_artist_id in tastes_artists_id:
-        taste_artist = TasteArtist.get_by_id(taste_artist_id.id())  # Get taste
-
-        if taste_artist is None:
-            logging.error("taste_artist is None")
-            continue
-
-        if taste_artist.taste >= 0.99 and taste_artist.added:
-            artist_id = taste_artist.artist.id()  # Get artist id from taste
-            artist = Artist.get_by_id(artist_id)  # Get artist by id
-
-            artists.append({"idIMDB": artist_id,
-                            "name": artist.name.encode('utf-8') if artist.name is not None else None,
-                            "tasted": 1,
-                            "photo": artist.photo})
-
-    tastes_movies_id = user.tastes_movies
+    for artist_id, artist in get_tasted_artists(user, 0.99):
+        artists.append({"idIMDB": artist_id,
+                        "name": artist.name.encode('utf-8') if artist.name is not None else None,
+                        "tasted": 1,
+                        "photo": artist.photo})
 
     movies = []
 
-    for taste_movie_id in tastes_movies_id:
-        taste_movie = TasteMovie.get_by_id(taste_movie_id.id())  # Get taste
-
-        if taste_movie is None:
-            logging.error("taste_movie is None")
-            continue
-        if taste_movie.taste >=1 and taste_movie.added :
-            movie_id = taste_movie.movie.id()  # Get movie id from taste
-            movie = Movie.get_by_id(movie_id)  # Get movie by id
-
-            movies.append({"idIMDB": movie_id,
+    for movie_id, movie in get_tasted_movies(user):
+        movies.append({"idIMDB": movie_id,
                        "originalTitle": movie.original_title.encode('utf-8') if movie.original_title is not None else movie.title.encode('utf-8'),
                        "title": movie.title.encode('utf-8') if movie.title is not None else movie.original_title.encode('utf-8'),
                        "tasted": 1,
                        "poster": movie.poster})
 
-    tastes_genres_id = user.tastes_genres
-
     genres = []
 
-    for taste_genre_id in tastes_genres_id:
-        taste_genre = TasteGenre.get_by_id(taste_genre_id.id())  # Get taste
-        if taste_genre is None:
-            logging.error("taste_genre is None")
-            continue
-
-        # TODO: not use object, use a simple list
-        if taste_genre.taste >= 0.99 and taste_genre.added :
-            genres.append({"name": taste_genre.genre,
-                           "tasted": 1})
+    # TODO: not use object, use a simple list
+    for genre in get_tasted_genres(user, 0.99):
+        genres.append({"name": genre,
+                       "tasted": 1})
 
     dataJson = {"userId": user.key.id(),
                          "type": "all",
@@ -0,0 +1 @@
+"""Offline benchmark of the service, see benchmark/run.py."""
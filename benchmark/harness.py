@@ -0,0 +1,282 @@
+"""
+Local stand-ins of the App Engine services and of the outbound HTTP requests, used by the benchmark to drive the real
+Flask apps without network.
+"""
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def setup_sdk(sdk_path):
+    """
+    Make importable the App Engine SDK, its bundled libraries and the modules of the service.
+    :param sdk_path: path of the App Engine SDK (the google_appengine directory)
+    :type sdk_path: string
+    :return: None
+    """
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+    sys.path.insert(0, ROOT_PATH)
+    import appengine_config  # Adds lib to the path, as it happens on App Engine
+
+
+class FixtureFetcher(object):
+    """
+    Replacement of utilities.get that answers with the recorded pages listed in fixtures/manifest.json.
+    Every route has a regular expression of the URL and the file to answer with. The named groups of the expression
+    replace the {{name}} placeholders of the file. If the route is a table, the file is a JSON object and the answer is
+    the value under the "key" group (or "missing" when there is not).
+    """
+
+    def __init__(self, fixtures_path=FIXTURES_PATH):
+        """
+        Constructor of FixtureFetcher.
+        :param fixtures_path: directory with the manifest and the recorded pages
+        :type fixtures_path: string
+        :return: None
+        """
+        with io.open(os.path.join(fixtures_path, 'manifest.json'), encoding='utf-8') as manifest:
+            routes = json.load(manifest)['routes']
+
+        self.routes = []
+        for route in routes:
+            with io.open(os.path.join(fixtures_path, route['file']), encoding='utf-8') as fixture:
+                body = fixture.read()
+            if route.get('table', False):
+                body = json.loads(body)
+            self.routes.append((re.compile(route['pattern']), body, route.get('table', False), route.get('missing')))
+
+        self.fetches = Counter()
+        self.not_modified = 0
+
+    def __call__(self, url):
+        """
+        Answer as utilities.get would do.
+        :param url: URL of the page to retrieve
+        :type url: string
+        :return: page
+        :rtype: unicode
+        :raise IOError: if there is not a fixture for the URL
+        """
+        for pattern, body, table, missing in self.routes:
+            match = pattern.match(url)
+            if match is None:
+                continue
+
+            self.fetches[url.split('/')[2]] += 1  # Count by host
+            if table:
+                value = body.get(match.group('key'))
+                return missing if value is None else json.dumps(value)
+
+            for name, value in match.groupdict().items():
+                body = body.replace('{{' + name + '}}', value)
+            return body
+
+        raise IOError('No fixture for ' + url)
+
+    def fetch(self, url, headers=None):
+        """
+        Answer as utilities.fetch would do. The ETag of a page is the hash of its body, so a conditional request for
+        an unchanged page is answered with 304.
+        :param url: URL of the page to retrieve
+        :type url: string
+        :param headers: headers of the request
+        :type headers: dict
+        :return: response
+        :rtype: FixtureResponse
+        """
+        body = self(url)
+        etag = '"' + hashlib.md5(body.encode('utf-8')).hexdigest() + '"'
+        if headers is not None and headers.get('If-None-Match') == etag:
+            self.not_modified += 1
+            return FixtureResponse(304, u'', etag)
+
+        return FixtureResponse(200, body, etag)
+
+    def install(self):
+        """
+        Replace utilities.get in the modules of the service that imported it, and utilities.fetch.
+        :return: None
+        """
+        import utilities
+
+        original = utilities.get
+        for module in list(sys.modules.values()):
+            if module is not None and getattr(module, 'get', None) is original:
+                module.get = self
+        utilities.fetch = self.fetch
+
+
+class FixtureResponse(object):
+    """
+    Response of FixtureFetcher.fetch, with the attributes of requests.Response used by the service.
+    """
+
+    def __init__(self, status_code, text, etag):
+        """
+        Constructor of FixtureResponse.
+        :param status_code: HTTP status code
+        :type status_code: int
+        :param text: body
+        :type text: unicode
+        :param etag: ETag of the body
+        :type etag: string
+        :return: None
+        """
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode('utf-8')
+        self.headers = {'ETag': etag}
+
+
+class RpcCounter(object):
+    """
+    Count the calls to the App Engine services and the entities read or written with them.
+    """
+
+    def __init__(self):
+        """
+        Constructor of RpcCounter.
+        :return: None
+        """
+        self.counts = Counter()
+
+    def __call__(self, service, call, request, response):
+        """
+        Pre-call hook of the API proxy.
+        """
+        self.counts[service + '.' + call] += 1
+        if service == 'datastore_v3':
+            if call == 'Get':
+                self.counts['datastore gets'] += request.key_size()
+            elif call == 'Put':
+                self.counts['datastore puts'] += request.entity_size()
+            elif call == 'Delete':
+                self.counts['datastore deletes'] += request.key_size()
+            elif call == 'RunQuery':
+                self.counts['datastore queries'] += 1
+
+    def install(self):
+        """
+        Register the hook in the current API proxy.
+        :return: None
+        """
+        from google.appengine.api import apiproxy_stub_map
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('benchmark', self)
+
+
+class Environment(object):
+    """
+    In-memory datastore, memcache and task queue with the apps of the service on top of them.
+    """
+
+    def __init__(self):
+        """
+        Constructor of Environment, it activates the stubs and imports the apps.
+        :return: None
+        """
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='hale-kite-786', overwrite=True)
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT_PATH)
+        self.testbed.init_urlfetch_stub()
+        self.testbed.init_user_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+        import api
+        import task
+        self.clients = [('/api/', api.app.test_client()), ('/_ah/start/task/', task.app.test_client())]
+
+        self.fetcher = FixtureFetcher()
+        self.fetcher.install()
+        self.rpcs = RpcCounter()
+        self.rpcs.install()
+        self.requests = 0
+        self.errors = 0
+
+    def close(self):
+        """
+        Deactivate the stubs.
+        :return: None
+        """
+        self.testbed.deactivate()
+
+    def request(self, url, method='GET', data=None):
+        """
+        Serve a request with a fresh ndb context, as App Engine does for every request.
+        :param url: path with the query string
+        :type url: string
+        :param method: HTTP method
+        :type method: string
+        :param data: JSON body
+        :type data: dict
+        :return: response
+        :rtype: flask.Response
+        """
+        from google.appengine.ext import ndb
+
+        ndb.get_context().clear_cache()
+        for prefix, client in self.clients:
+            if url.startswith(prefix):
+                self.requests += 1
+                response = client.open(url, method=method, data=json.dumps(data) if data is not None else None,
+                                       content_type='application/json')
+                if response.status_code >= 400:
+                    self.errors += 1
+                return response
+
+        raise ValueError('No app for ' + url)
+
+    def drain(self):
+        """
+        Run the enqueued tasks, and the ones they enqueue, until the queue is empty.
+        :return: number of tasks run
+        :rtype: int
+        """
+        count = 0
+        while True:
+            tasks = self.taskqueue.get_filtered_tasks(queue_names=['default'])  # The service uses only it
+            if len(tasks) == 0:
+                return count
+
+            self.taskqueue.FlushQueue('default')
+            for task in tasks:
+                self.request(task.url, task.method)
+                count += 1
+
+    def snapshot(self):
+        """
+        Current value of the counters.
+        :return: counters
+        :rtype: Counter
+        """
+        from google.appengine.api import memcache
+
+        counts = Counter(self.rpcs.counts)
+        stats = memcache.get_stats()
+        counts['memcache hits'] = stats['hits']
+        counts['memcache misses'] = stats['misses']
+        counts['fetches'] = sum(self.fetcher.fetches.values())
+        counts['not modified'] = self.fetcher.not_modified
+        counts['requests'] = self.requests
+        counts['errors'] = self.errors
+        counts['wall ms'] = time.time() * 1000
+        return counts
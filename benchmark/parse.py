@@ -0,0 +1,84 @@
+"""
+Offline benchmark of the parser of the FilmTV schedule pages.
+
+Every recorded schedule page of benchmark/fixtures is parsed many times, alone and repeated to the length of a busy
+evening, and the time to parse a page is reported:
+
+    python -m benchmark.parse --sdk /path/to/google_appengine --repeat 200
+
+Run it before and after a change of the parser to compare them.
+"""
+import argparse
+import glob
+import io
+import json
+import logging
+import os
+import timeit
+
+from harness import FIXTURES_PATH, setup_sdk
+
+
+def long_page(page, copies):
+    """
+    Return the page with its movies repeated, as the schedule of a busy evening. The copies are doubles that the parser
+    removes.
+    :param page: schedule page
+    :type page: unicode
+    :param copies: times the movies are repeated
+    :type copies: int
+    :return: page
+    :rtype: unicode
+    """
+    articles = page[page.index('<article'):page.rindex('</article>') + len('</article>')]
+    return page.replace('</section>', articles * (copies - 1) + '</section>')
+
+
+def run(repeat, copies):
+    """
+    Time the parser on the schedule pages of the fixtures.
+    :param repeat: times every page is parsed
+    :type repeat: int
+    :param copies: times the movies are repeated in the long pages
+    :type copies: int
+    :return: page, movies found and milliseconds to parse it
+    :rtype: list of tuple
+    """
+    from tv_scheduling import get_movies_schedule
+
+    results = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_PATH, 'filmtv_schedule_*.html'))):
+        with io.open(path, encoding='utf-8') as fixture:
+            page = fixture.read()
+
+        for name, html_page in [(os.path.basename(path), page), (os.path.basename(path) + ' x%d' % copies,
+                                                                  long_page(page, copies))]:
+            movies = len(get_movies_schedule(html_page))
+            seconds = timeit.timeit(lambda: get_movies_schedule(html_page), number=repeat)
+            results.append((name, movies, seconds * 1000 / repeat))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the parser of the FilmTV schedule pages')
+    parser.add_argument('--sdk', required=True, help='path of the App Engine SDK (google_appengine)')
+    parser.add_argument('--repeat', type=int, default=200, help='times every page is parsed (default 200)')
+    parser.add_argument('--copies', type=int, default=10, help='times the movies are repeated (default 10)')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.CRITICAL)  # The parser logs the doubles
+    setup_sdk(args.sdk)
+
+    results = run(args.repeat, args.copies)
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        print '%-36s%8s%12s' % ('page', 'movies', 'ms/page')
+        for name, movies, milliseconds in results:
+            print '%-36s%8d%12.3f' % (name, movies, milliseconds)
+
+
+if __name__ == '__main__':
+    main()
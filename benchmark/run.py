@@ -0,0 +1,178 @@
+"""
+Offline end-to-end benchmark of the service.
+
+The datastore, memcache and task queue are the in-memory stubs of the App Engine SDK and the pages of FilmTV, MyAPIFilms
+and IMDb are replayed from benchmark/fixtures, so it runs on a laptop without network:
+
+    python -m benchmark.run --sdk /path/to/google_appengine --users 200
+
+For every scenario it reports the wall time, the entities read and written in the datastore, the hits and misses of
+memcache and the pages fetched, with how many of them were not modified.
+"""
+import argparse
+import json
+import logging
+import random
+
+from harness import setup_sdk
+
+COLUMNS = ['requests', 'errors', 'wall ms', 'datastore gets', 'datastore puts', 'datastore queries',
+           'memcache hits', 'memcache misses', 'fetches', 'not modified']
+
+
+def create_users(env, number, seed):
+    """
+    Store users with random tv types and random tastes about the artists, movies and genres already in the datastore.
+    :param env: benchmark environment
+    :type env: harness.Environment
+    :param number: number of users
+    :type number: int
+    :param seed: seed of the random choices
+    :type seed: int
+    :return: ids of the users
+    :rtype: list of string
+    """
+    from google.appengine.ext import ndb
+    from models import Artist, Movie, User
+    from utilities import GENRES, TV_TYPE
+
+    rand = random.Random(seed)
+    artists = Artist.query().fetch(keys_only=True)
+    movies = Movie.query().fetch(keys_only=True)
+
+    users = []
+    for i in range(number):
+        user = User(id='user%d@example.com' % i, name='User %d' % i,
+                    tv_type=rand.sample(TV_TYPE, rand.randint(1, len(TV_TYPE))))
+        for artist in rand.sample(artists, min(len(artists), rand.randint(5, 30))):
+            user.tastes.set("artist", artist.id(), rand.choice([1.0, 1.2, 1.6, 2.0, -0.2]), rand.random() < 0.5)
+        for movie in rand.sample(movies, min(len(movies), rand.randint(1, 5))):
+            user.tastes.set("movie", movie.id(), 1.0, True)
+        for genre in rand.sample(GENRES, rand.randint(1, 5)):
+            user.tastes.set("genre", genre, rand.choice([1.0, 1.15, 1.3]), rand.random() < 0.5)
+        user.tastes.put()
+        users.append(user)
+
+    ndb.put_multi(users)
+    return [user.key.id() for user in users]
+
+
+def scenario_retrieve(env, users):
+    """
+    Nightly retrieve: scrape the schedule of every tv type and retrieve its movies from MyAPIFilms.
+    """
+    env.request('/_ah/start/task/retrieve/today')
+    env.drain()
+
+
+def scenario_proposal(env, users):
+    """
+    Proposal fan-out: the suggest cron computes the proposal of every user.
+    """
+    env.request('/_ah/start/task/suggest')
+    env.drain()
+
+
+def scenario_tastes(env, users):
+    """
+    Tastes listing: every user opens the list of his tastes.
+    """
+    for user_id in users:
+        env.request('/api/tastes/' + user_id + '/all')
+        env.request('/api/tastes/' + user_id + '/artist')
+
+
+def scenario_detail(env, users):
+    """
+    Detail: the detail of every movie of the schedule and of its director.
+    """
+    from models import Movie
+
+    for movie in Movie.query().fetch():
+        env.request('/api/detail/movie/' + movie.key.id())
+        for director in movie.directors:
+            env.request('/api/detail/artist/' + director.id())
+
+
+def scenario_suggest(env, users):
+    """
+    Suggest: the users type the queries letter by letter.
+    """
+    for user_id in users[:20]:
+        for query in ['t', 'to', 'tom', 'f', 'fo', 'for']:
+            env.request('/api/suggest/' + user_id + '/' + query)
+
+
+SCENARIOS = [('retrieve', scenario_retrieve), ('proposal', scenario_proposal), ('tastes', scenario_tastes),
+             ('detail', scenario_detail), ('suggest', scenario_suggest)]
+
+
+def run(scenarios, number_users, seed):
+    """
+    Run the scenarios one after the other on the same environment.
+    :param scenarios: names of the scenarios to run, the nightly retrieve is always run first
+    :type scenarios: list of string
+    :param number_users: number of users to create after the nightly retrieve
+    :type number_users: int
+    :param seed: seed of the random choices
+    :type seed: int
+    :return: counters of every scenario
+    :rtype: list of tuple
+    """
+    from harness import Environment
+
+    env = Environment()
+    results = []
+    users = []
+    try:
+        for name, scenario in SCENARIOS:
+            if name != 'retrieve' and name not in scenarios:
+                continue
+
+            before = env.snapshot()
+            scenario(env, users)
+            after = env.snapshot()
+            results.append((name, dict((column, after[column] - before[column]) for column in COLUMNS)))
+
+            if name == 'retrieve':  # The users taste what has been retrieved
+                users = create_users(env, number_users, seed)
+    finally:
+        env.close()
+
+    return results
+
+
+def print_table(results):
+    """
+    Print the results as a table.
+    :param results: counters of every scenario
+    :type results: list of tuple
+    :return: None
+    """
+    print '%-10s' % 'scenario' + ''.join('%17s' % column for column in COLUMNS)
+    for name, counts in results:
+        print '%-10s' % name + ''.join('%17d' % counts[column] for column in COLUMNS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of PRIMETIME4U')
+    parser.add_argument('--sdk', required=True, help='path of the App Engine SDK (google_appengine)')
+    parser.add_argument('--users', type=int, default=100, help='number of users (default 100)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random tastes (default 0)')
+    parser.add_argument('--scenario', action='append', choices=[name for name, scenario in SCENARIOS],
+                        help='scenario to run, it can be repeated (default all)')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.CRITICAL)  # The service logs a lot
+    setup_sdk(args.sdk)
+
+    results = run(args.scenario or [name for name, scenario in SCENARIOS], args.users, args.seed)
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 from google.appengine.api import users
 from google.appengine.api.users import UserNotFoundError
-from models import User as modelUser
+from google.appengine.ext import ndb
+from models import User as modelUser, Proposal, forget_deferred
 
 
 class User(users.User):
@@ -17,7 +18,8 @@ class User(users.User):
         :type birth_year: string
         :param gender: gender of the user
         :type gender: string
-        :return None
+        :return: the new user
+        :rtype: models.User
         """
         user = modelUser(id=self.email(),
                          name=self.nickname())
@@ -35,6 +37,7 @@ class User(users.User):
         user.modify_tv_type(tv_type)
 
         user.put()
+        return user
 
     def unsubscribe(self):
         """
@@ -42,7 +45,10 @@ class User(users.User):
         :return None
         """
         user = self.get_ndb_user()
-        user.key.delete()
+        user.tastes.delete()
+        keys = [user.key] + Proposal.user_keys(user.key.id())
+        forget_deferred(keys)
+        ndb.delete_multi(keys)
 
     def is_subscribed(self):
         """
@@ -1,10 +1,19 @@
 from google.appengine.api.taskqueue import taskqueue
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 from datetime import date
 from google.appengine.api import taskqueue
+from google.appengine.api import memcache
+import json
 import logging
+import re
+import threading
+import unicodedata
+from collections import OrderedDict, namedtuple
 
-from utilities import TV_TYPE, GENRES, ACTOR_WEIGHT, DIRECTOR_WEIGHT, WRITER_WEIGHT, GENRE_WEIGHT
+from utilities import TV_TYPE, GENRES, ROLES, TASTE_KINDS, ACTOR_WEIGHT, DIRECTOR_WEIGHT, WRITER_WEIGHT, GENRE_WEIGHT
+from utilities import SCHEDULE_FIELDS, SCHEDULE_TABLES, PROPOSAL_FIELDS, PROPOSAL_TABLES, encode_records, \
+    decode_records
 
 
 class ModelUtils(object):
@@ -15,6 +24,16 @@ class ModelUtils(object):
         :return: model in dict readable form
         :rtype: list of dict
         """
+        return self.readable_dict()
+
+    def readable_dict(self, artists=None):
+        """
+        Return a key-value dict of model, movie's artists are taken from artists if given.
+        :param artists: artists already retrieved, indexed by key
+        :type artists: dict of Artist
+        :return: model in dict readable form
+        :rtype: dict
+        """
         result = super(ModelUtils, self).to_dict()
 
         if type(self) is Movie:
@@ -41,26 +60,291 @@ class ModelUtils(object):
 
             result['genres'] = " | ".join(result['genres'])
 
-            actors = []
-            for actor in result['actors']:
-                actor = Artist.get_by_id(actor.get().key.id())
-                actors.append(actor.to_dict)
-            result['actors'] = actors  # Return a list of actors' name
-
-            directors = []
-            for director in result['directors']:
-                director = Artist.get_by_id(director.get().key.id())
-                directors.append(director.to_dict)
-            result['directors'] = directors  # Return a list of directors' name
-
-            writers = []
-            for writer in result['writers']:
-                writer = Artist.get_by_id(writer.get().key.id())
-                writers.append(writer.to_dict)
-            result['writers'] = writers  # Return a list of writers' name
+            if artists is None:
+                artists = get_movies_artists([self])  # Get all credited artists in one call
+
+            result['actors'] = [artists[actor].to_dict for actor in result['actors']
+                                if actor in artists]  # Return a list of actors' name
+            result['directors'] = [artists[director].to_dict for director in result['directors']
+                                   if director in artists]  # Return a list of directors' name
+            result['writers'] = [artists[writer].to_dict for writer in result['writers']
+                                 if writer in artists]  # Return a list of writers' name
         return result
 
 
+class WriteBatch(object):
+    """
+    Unit of work that collects the entities to store and writes them with a single multi-put.
+    An entity added more times is written once, in its last version, and entities equal to the stored ones are
+    skipped.
+    """
+
+    def __init__(self):
+        """
+        Constructor of WriteBatch.
+        :return: None
+        """
+        self.entities = OrderedDict()
+
+    def add(self, entity):
+        """
+        Add entity to the batch, the entity must have a complete key.
+        :param entity: entity to store
+        :type entity: ndb.Model
+        :return: entity's key
+        :rtype: ndb.Key
+        """
+        self.entities[entity.key] = entity
+
+        return entity.key
+
+    def flush(self):
+        """
+        Store all changed entities of the batch and empty it.
+        :return: keys of the entities written
+        :rtype: list of ndb.Key
+        """
+        entities = self.entities.values()
+        self.entities = OrderedDict()
+
+        stored_entities = ndb.get_multi([entity.key for entity in entities],
+                                        use_cache=False)  # The context cache could hold the entities themselves
+        changed = [entity for entity, stored_entity in zip(entities, stored_entities) if entity != stored_entity]
+        logging.info("Writing %d of %d entities", len(changed), len(entities))
+
+        return ndb.put_multi(changed)
+
+
+_write_scope = threading.local()
+
+
+class DeferredPut(object):
+    """
+    Mixin for models written many times in a request: inside a write scope put() of an entity already stored only
+    marks it as dirty and every dirty entity is written once, together with the others, when the scope ends. New
+    entities are written at once, so they can be read by key in the rest of the request.
+    """
+
+    @classmethod
+    def _from_pb(cls, pb, set_key=True, ent=None, key=None):
+        """
+        Build the entity read from the datastore, marking it as stored.
+        :return: entity
+        :rtype: ndb.Model
+        """
+        entity = super(DeferredPut, cls)._from_pb(pb, set_key=set_key, ent=ent, key=key)
+        entity._stored = True
+        return entity
+
+    @classmethod
+    def get_by_id(cls, id, parent=None, **ctx_options):
+        """
+        Return the entity with the given id, the one waiting to be written if there is.
+        :return: entity or None
+        :rtype: ndb.Model
+        """
+        entities = getattr(_write_scope, 'entities', None)
+        if entities is not None:
+            entity = entities.get(ndb.Key(cls, id, parent=parent))
+            if entity is not None:
+                return entity
+
+        return super(DeferredPut, cls).get_by_id(id, parent=parent, **ctx_options)
+
+    def put(self, **ctx_options):
+        """
+        Store the entity now or, inside a write scope and if it is already stored, when the scope ends.
+        :return: entity's key
+        :rtype: ndb.Key
+        """
+        entities = getattr(_write_scope, 'entities', None)
+        if entities is None or not getattr(self, '_stored', False):
+            key = super(DeferredPut, self).put(**ctx_options)
+            self._stored = True
+            return key
+
+        entities[self.key] = self
+
+        return self.key
+
+    def _pre_put_hook(self):
+        """
+        An entity written directly, with put_multi or put_async too, supersedes its deferred write.
+        :return: None
+        """
+        entities = getattr(_write_scope, 'entities', None)
+        if entities is not None and self.key is not None:
+            entities.pop(self.key, None)
+
+        super(DeferredPut, self)._pre_put_hook()
+
+
+def begin_write_scope():
+    """
+    Start deferring the writes of DeferredPut entities, the transactions added with add_transaction and the tasks
+    added with add_task.
+    :return: None
+    """
+    _write_scope.entities = OrderedDict()
+    _write_scope.transactions = OrderedDict()
+    _write_scope.tasks = []
+
+
+def end_write_scope():
+    """
+    Run each deferred transaction once, write each dirty entity of the scope once, with a single multi-put, then add
+    the deferred tasks.
+    :return: None
+    """
+    transactions = getattr(_write_scope, 'transactions', None)
+    _write_scope.transactions = None
+    for function in (transactions or {}).values():  # They can write some of the dirty entities themselves
+        function()
+
+    entities = getattr(_write_scope, 'entities', None)
+    tasks = getattr(_write_scope, 'tasks', [])
+    _write_scope.entities = None
+    _write_scope.tasks = None
+
+    if entities:
+        logging.info("Writing %d deferred entities", len(entities))
+        ndb.put_multi(entities.values())
+
+    for task in tasks or []:  # Tasks could read the entities, so they are added after the writes
+        taskqueue.add(**task)
+
+
+def discard_write_scope():
+    """
+    Close the write scope dropping the deferred writes and tasks, the request that made them has failed.
+    :return: None
+    """
+    entities = getattr(_write_scope, 'entities', None)
+    tasks = getattr(_write_scope, 'tasks', None)
+    _write_scope.entities = None
+    _write_scope.transactions = None
+    _write_scope.tasks = None
+
+    if entities or tasks:
+        logging.warning("Discarded %d deferred entities and %d tasks", len(entities or []), len(tasks or []))
+
+
+def forget_deferred(keys):
+    """
+    Drop the deferred writes of the entities that are going to be deleted.
+    :param keys: keys of the entities
+    :type keys: list of ndb.Key
+    :return: None
+    """
+    entities = getattr(_write_scope, 'entities', None)
+    if entities is not None:
+        for key in keys:
+            entities.pop(key, None)
+
+
+def add_transaction(key, function):
+    """
+    Run a function now or, inside a write scope, once when the scope ends, before the deferred writes.
+    :param key: key of the entity the function writes, the function is run once for each key
+    :type key: ndb.Key
+    :param function: function without arguments
+    :type function: function
+    :return: None
+    """
+    transactions = getattr(_write_scope, 'transactions', None)
+    if transactions is None:
+        function()
+    else:
+        transactions[key] = function
+
+
+def is_deferred(key):
+    """
+    Check if the write of an entity is deferred to the end of the write scope.
+    :param key: key of the entity
+    :type key: ndb.Key
+    :return: True if the entity is waiting to be written
+    :rtype: bool
+    """
+    entities = getattr(_write_scope, 'entities', None)
+    return entities is not None and key in entities
+
+
+def add_task(url, method='GET', params=None):
+    """
+    Add a task to the default queue, inside a write scope the task is added after the deferred writes.
+    :param url: url of the task
+    :type url: string
+    :param method: HTTP method of the task
+    :type method: string
+    :param params: parameters of the task
+    :type params: dict
+    :return: None
+    """
+    task = {'url': url, 'method': method}
+    if params is not None:
+        task['params'] = params
+
+    tasks = getattr(_write_scope, 'tasks', None)
+    if tasks is None:
+        taskqueue.add(**task)
+    else:
+        tasks.append(task)
+
+
+def coalesce_writes(app):
+    """
+    Open a write scope for each request of a Flask app, so each entity is written at most once per request. The writes
+    of a request that raises an exception, handled or not, are dropped.
+    :param app: Flask app
+    :type app: Flask
+    :return: app
+    :rtype: Flask
+    """
+    handle_user_exception = app.handle_user_exception
+
+    def discard_and_handle(error):
+        discard_write_scope()
+        return handle_user_exception(error)
+
+    app.handle_user_exception = discard_and_handle
+
+    @app.before_request
+    def open_write_scope():
+        begin_write_scope()
+
+    @app.after_request
+    def close_write_scope(response):
+        end_write_scope()  # An error here is an error of the request
+        return response
+
+    @app.teardown_request
+    def close_write_scope_on_error(exception):
+        if getattr(_write_scope, 'entities', None) is not None:  # The request failed before after_request
+            discard_write_scope()
+
+    return app
+
+
+def get_movies_artists(movies):
+    """
+    Get all actors, directors and writers of movies with a single multi-get.
+    :param movies: movies of which retrieve the artists
+    :type movies: list of Movie
+    :return: artists indexed by key
+    :rtype: dict of Artist
+    """
+    keys = []
+    seen = set()
+    for movie in movies:
+        for key in movie.actors + movie.directors + movie.writers:
+            if key not in seen:  # An artist could have more roles or be in more movies
+                seen.add(key)
+                keys.append(key)
+
+    return dict((artist.key, artist) for artist in ndb.get_multi(keys) if artist is not None)
+
+
 class Artist(ModelUtils, ndb.Model):
     """
     Simple artist model.
@@ -79,8 +363,30 @@ class Artist(ModelUtils, ndb.Model):
         :return: all movies in which the artist took part
         :rtype: list of Movie
         """
-        return Movie.query().filter(
-            Movie.actors == self.key or Movie.writers == self.key or Movie.directors == self.key)
+        credits_list = Credit.query(Credit.artist == self.key).fetch()
+
+        return [movie for movie in ndb.get_multi([credit.movie for credit in credits_list]) if movie is not None]
+
+    def filmography(self, page_size=10, cursor=None):
+        """
+        Return a page of the movies of an artist, with the roles the artist had in each of them.
+        :param page_size: number of movies in the page
+        :type page_size: int
+        :param cursor: cursor returned with the previous page, None for the first one
+        :type cursor: string
+        :return: movies of the page, cursor of the next page (None if it is the last one)
+            ([{"movie": movie, "roles": ["actor", "director", "writer"]}, ..], next_cursor)
+        :rtype: tuple
+        """
+        start_cursor = Cursor(urlsafe=cursor) if cursor is not None else None
+        credits_list, next_cursor, more = Credit.query(Credit.artist == self.key).fetch_page(page_size,
+                                                                                             start_cursor=start_cursor)
+        movies = ndb.get_multi([credit.movie for credit in credits_list])  # Get all movies of the page together
+
+        page = [{"movie": movie, "roles": credit.roles} for credit, movie in zip(credits_list, movies)
+                if movie is not None]
+
+        return page, next_cursor.urlsafe() if more and next_cursor is not None else None
 
 
 class Movie(ModelUtils, ndb.Model):
@@ -107,43 +413,267 @@ class Movie(ModelUtils, ndb.Model):
     poster = ndb.StringProperty()
     keywords = ndb.StringProperty(repeated=True)
 
-    def add_actor(self, actor):
+    def add_actor(self, actor, batch=None):
         """
         Add actor to movie.
         :param actor: actor to add
         :type actor: Artist
+        :param batch: batch in which collect the writes, if None the movie is stored immediately
+        :type batch: WriteBatch
         :return: None
         """
         if actor.key not in self.actors:
             self.actors.append(actor.key)
-            self.put()
+            self.store_credit(actor.key, batch)
 
-    def add_director(self, director):
+    def add_director(self, director, batch=None):
         """
         Add director to movie.
         :param director: director to add
         :type director: Artist
+        :param batch: batch in which collect the writes, if None the movie is stored immediately
+        :type batch: WriteBatch
         :return: None
         """
         if director.key not in self.directors:
             self.directors.append(director.key)
-            self.put()
+            self.store_credit(director.key, batch)
 
-    def add_writer(self, writer):
+    def add_writer(self, writer, batch=None):
         """
         Add writer to movie.
         :param writer: writer to add
         :type writer: Artist
+        :param batch: batch in which collect the writes, if None the movie is stored immediately
+        :type batch: WriteBatch
         :return: None
         """
         if writer.key not in self.writers:
             self.writers.append(writer.key)
-            self.put()
+            self.store_credit(writer.key, batch)
+
+    def store_credit(self, artist_key, batch=None):
+        """
+        Store the movie and update the filmography of one of its artists.
+        :param artist_key: key of the artist credited
+        :type artist_key: ndb.Key
+        :param batch: batch in which collect the writes, if None they are done immediately
+        :type batch: WriteBatch
+        :return: None
+        """
+        credit = Credit.from_movie(self, artist_key)
+
+        if batch is not None:
+            batch.add(self)
+            batch.add(credit)
+        else:
+            ndb.put_multi([self, credit])
+
+
+class Credit(ndb.Model):
+    """
+    This model represents the part of an artist in a movie, it is the index behind the filmography of an artist.
+    The id value is the id of the artist followed by the id of the movie.
+    Do not create it directly, use:
+        Credit.from_movie(movie, artist_key)
+    """
+    artist = ndb.KeyProperty(Artist, required=True)
+    movie = ndb.KeyProperty(Movie, required=True)
+    roles = ndb.StringProperty(choices=ROLES, repeated=True, indexed=False)
+
+    @classmethod
+    def from_movie(cls, movie, artist_key):
+        """
+        Build the credit of an artist reading the roles from the credits lists of the movie.
+        :param movie: movie in which the artist took part
+        :type movie: Movie
+        :param artist_key: key of the artist
+        :type artist_key: ndb.Key
+        :return: credit of the artist, not stored yet
+        :rtype: Credit
+        """
+        roles = []
+        if artist_key in movie.actors:
+            roles.append("actor")
+        if artist_key in movie.directors:
+            roles.append("director")
+        if artist_key in movie.writers:
+            roles.append("writer")
+
+        return cls(id=(artist_key.id() + movie.key.id()),
+                   artist=artist_key,
+                   movie=movie.key,
+                   roles=roles)
+
+    @classmethod
+    def index_movie(cls, movie):
+        """
+        Build the credits of all artists of a movie.
+        :param movie: movie to index
+        :type movie: Movie
+        :return: credits of the movie, not stored yet
+        :rtype: list of Credit
+        """
+        artist_keys = []
+        for key in movie.actors + movie.directors + movie.writers:
+            if key not in artist_keys:
+                artist_keys.append(key)
+
+        return [cls.from_movie(movie, artist_key) for artist_key in artist_keys]
+
+
+MAX_CACHED_TITLES = 5000
+MAX_TITLE_LENGTH = 400  # Bytes of a normalized title, a key name is at most 500 bytes
+
+_titles_cache = {}  # In-process cache of the title index: normalized title -> Movie's key
+
+
+def normalize_title(title):
+    """
+    Return the normalized form of a title used by the title index: lower case, without accents and punctuation.
+    :param title: title of a movie
+    :type title: string
+    :return: normalized title or None if title is empty
+    :rtype: string
+    """
+    if title is None:
+        return None
+    if isinstance(title, str):
+        title = title.decode('utf-8', 'ignore')
+
+    title = u"".join(char for char in unicodedata.normalize('NFKD', title) if not unicodedata.combining(char))
+    title = re.sub(r'[\W_]+', u" ", title, flags=re.UNICODE).strip().lower()
+
+    if title == u"":
+        return None
+
+    title = title[:MAX_TITLE_LENGTH].encode('utf-8')  # Truncated as unicode, not in the middle of a character
+    if len(title) > MAX_TITLE_LENGTH:
+        title = title[:MAX_TITLE_LENGTH].decode('utf-8', 'ignore').encode('utf-8')
+
+    return title
+
+
+class MovieTitle(ndb.Model):
+    """
+    This model represents the title index: it maps the titles used by FilmTV to the movie in the datastore.
+    The id value is the normalized title.
+    """
+    movie = ndb.KeyProperty(Movie, indexed=False)
+
+    @classmethod
+    def index_movie(cls, movie):
+        """
+        Build the index entries of the title and of the original title of a movie and cache them.
+        :param movie: movie to index
+        :type movie: Movie
+        :return: entries of the movie, not stored yet
+        :rtype: list of MovieTitle
+        """
+        names = []
+        for title in (movie.original_title, movie.title):
+            name = normalize_title(title)
+            if name is not None and name not in names:
+                names.append(name)
+
+        cache_titles(dict((name, movie.key) for name in names))
+
+        return [cls(id=name, movie=movie.key) for name in names]
+
+
+def cache_titles(keys_by_name):
+    """
+    Store resolved titles in the in-process cache and in memcache.
+    :param keys_by_name: Movie's keys by normalized title
+    :type keys_by_name: dict
+    :return: None
+    """
+    if len(_titles_cache) + len(keys_by_name) > MAX_CACHED_TITLES:
+        _titles_cache.clear()
+    _titles_cache.update(keys_by_name)
+
+    memcache.set_multi(dict((name, key.urlsafe()) for name, key in keys_by_name.items()), key_prefix='title:')
+
+
+def lookup_movie_keys(schedule_movies):
+    """
+    Find the movies of a schedule in the title index, the whole schedule is resolved together: first in the
+    in-process cache, then in memcache, then in the datastore. Movies stored before the index are searched by title
+    and added to the index.
+    Movies already resolved during the retrieve have their id in "idIMDB" and are not searched.
+    :param schedule_movies: movies schedule
+    :type schedule_movies: list of dict
+    :return: Movie's key of each movie in the schedule, None if the movie is not in the datastore
+    :rtype: list of ndb.Key
+    """
+    candidates = []  # Normalized titles of each movie, the original title first
+    for movie in schedule_movies:
+        if movie.get("idIMDB") is not None:
+            candidates.append([])
+            continue
+
+        names = [normalize_title(movie["originalTitle"]), normalize_title(movie["title"])]
+        candidates.append([name for name in names if name is not None])
+
+    names = set(name for movie_names in candidates for name in movie_names)
+    keys_by_name = dict((name, _titles_cache[name]) for name in names if name in _titles_cache)
+
+    not_found = set()  # Titles already searched and not found
+
+    missing = [name for name in names if name not in keys_by_name]
+    if len(missing) > 0:
+        cached = memcache.get_multi(missing, key_prefix='title:')
+        keys_by_name.update((name, ndb.Key(urlsafe=urlsafe)) for name, urlsafe in cached.items() if urlsafe != "")
+        not_found.update(name for name, urlsafe in cached.items() if urlsafe == "")
+
+        missing = [name for name in missing if name not in cached]
+        if len(missing) > 0:
+            entries = ndb.get_multi([ndb.Key(MovieTitle, name) for name in missing])
+            found = dict((entry.key.id(), entry.movie) for entry in entries if entry is not None)
+            keys_by_name.update(found)
+            cache_titles(found)
+
+    keys = []
+    for movie, movie_names in zip(schedule_movies, candidates):
+        if movie.get("idIMDB") is not None:
+            keys.append(ndb.Key(Movie, movie["idIMDB"]))
+            continue
+
+        key = next((keys_by_name[name] for name in movie_names if name in keys_by_name), None)
+
+        if key is None and len(movie_names) > 0 and not not_found.issuperset(movie_names):
+            # Not indexed yet, search it by title
+            movie_data_store = Movie.query(ndb.OR(Movie.original_title == movie["originalTitle"],
+                                                  Movie.title == movie["title"])).get()
+            if movie_data_store is not None:
+                ndb.put_multi(MovieTitle.index_movie(movie_data_store))
+                key = movie_data_store.key
+            else:  # Remember it until the movie is retrieved and indexed
+                memcache.set_multi(dict((name, "") for name in movie_names), key_prefix='title:', time=3600)
+
+        keys.append(key)
+
+    return keys
+
 
+def get_schedule_movies(schedule_movies):
+    """
+    Get the movies of a schedule from the datastore with a single multi-get.
+    :param schedule_movies: movies schedule
+    :type schedule_movies: list of dict
+    :return: Movie of each movie in the schedule, None if the movie is not in the datastore
+    :rtype: list of Movie
+    """
+    keys = lookup_movie_keys(schedule_movies)
+    movies = iter(ndb.get_multi([key for key in keys if key is not None]))
+
+    return [next(movies) if key is not None else None for key in keys]
 
-class TasteMovie(ModelUtils, ndb.Model):
+
+class TasteMovie(DeferredPut, ModelUtils, ndb.Model):
     """
     This model represents the taste of a user about a movie.
+    Tastes are now stored in TasteProfile, it is kept in order to migrate the old ones.
     """
     movie = ndb.KeyProperty(Movie)
     taste = ndb.FloatProperty(required=True)
@@ -164,9 +694,10 @@ class TasteMovie(ModelUtils, ndb.Model):
         self.put()
 
 
-class TasteArtist(ModelUtils, ndb.Model):
+class TasteArtist(DeferredPut, ModelUtils, ndb.Model):
     """
     This model represents the taste of a user about an artist.
+    Tastes are now stored in TasteProfile, it is kept in order to migrate the old ones.
     """
     artist = ndb.KeyProperty(Artist)
     taste = ndb.FloatProperty(required=True)
@@ -187,9 +718,10 @@ class TasteArtist(ModelUtils, ndb.Model):
         self.put()
 
 
-class TasteGenre(ModelUtils, ndb.Model):
+class TasteGenre(DeferredPut, ModelUtils, ndb.Model):
     """
     This model represents the taste of a user about a genre.
+    Tastes are now stored in TasteProfile, it is kept in order to migrate the old ones.
     """
     genre = ndb.StringProperty(choices=GENRES)
     taste = ndb.FloatProperty(required=True)
@@ -200,7 +732,437 @@ class TasteGenre(ModelUtils, ndb.Model):
         self.put()
 
 
-class User(ModelUtils, ndb.Model):
+Taste = namedtuple('Taste', ['taste', 'added'])
+
+
+def increased_taste(current, taste):
+    """
+    Return a taste increased, or the new one if there is not.
+    :param current: current taste or None
+    :type current: Taste
+    :param taste: taste to add
+    :type taste: float
+    :return: new taste
+    :rtype: Taste
+    """
+    if current is None:
+        return Taste(taste, taste == 1.0)
+
+    return Taste(current.taste + taste, taste == 1 or current.added)
+
+
+def decreased_taste(current):
+    """
+    Return a taste decreased by one, or None if it has to be removed.
+    :param current: current taste or None
+    :type current: Taste
+    :return: new taste or None
+    :rtype: Taste
+    """
+    if current is None or (current.taste > 0.99 and current.taste <= 1) or current.taste == 0:
+        return None
+    elif current.taste > 1:
+        return Taste(current.taste - 1, False)
+
+    return current
+
+MAX_TASTES_PER_SHARD = 5000
+TASTE_TRANSACTION_RETRIES = 5
+
+
+class TasteProfile(ndb.Model):
+    """
+    This model represents a shard of all the tastes of a user, stored in parallel lists of kind, id, taste and added
+    flag. Do not use it directly, use UserTastes and the taste methods of User.
+    The id value of the first shard is the e-mail address of the user, the other ones have the number of the shard:
+        TasteProfile(id="email"), TasteProfile(id="email#1"), ..
+    """
+    kinds = ndb.StringProperty(choices=TASTE_KINDS, repeated=True, indexed=False)
+    ids = ndb.StringProperty(repeated=True, indexed=False)
+    tastes = ndb.FloatProperty(repeated=True, indexed=False)
+    added = ndb.BooleanProperty(repeated=True, indexed=False)
+    shards = ndb.IntegerProperty(default=1, indexed=False)  # Meaningful only in the first shard
+
+    @staticmethod
+    def shard_key(user_id, shard):
+        """
+        Return the key of a shard of the user's tastes.
+        :param user_id: email of the user
+        :type user_id: string
+        :param shard: number of the shard
+        :type shard: int
+        :return: key of the shard
+        :rtype: ndb.Key
+        """
+        return ndb.Key(TasteProfile, user_id if shard == 0 else user_id + "#" + str(shard))
+
+
+class UserTastes(object):
+    """
+    All the tastes of a user about artists, movies and genres, loaded with one or two reads from his TasteProfile.
+    Tastes are indexed by kind ("artist", "movie" or "genre") and by id (IMDb id or genre name).
+    """
+
+    def __init__(self, user_id, shards=0):
+        """
+        Constructor of UserTastes.
+        :param user_id: email of the user
+        :type user_id: string
+        :param shards: number of shards already stored
+        :type shards: int
+        :return: None
+        """
+        self.user_id = user_id
+        self.shards = shards
+        self.entries = dict((kind, OrderedDict()) for kind in TASTE_KINDS)
+
+    @classmethod
+    def load(cls, user):
+        """
+        Load the tastes of a user, they are read from the old Taste entities if the user has not a TasteProfile yet.
+        :param user: user
+        :type user: User
+        :return: tastes of the user
+        :rtype: UserTastes
+        """
+        return cls.load_multi([user])[0]
+
+    @classmethod
+    def load_multi(cls, users, legacy=True):
+        """
+        Load the tastes of many users together, with one read for the first shards and one for the others.
+        :param users: users
+        :type users: list of User
+        :param legacy: False to not read the old Taste entities of the users without a TasteProfile
+        :type legacy: bool
+        :return: tastes of the users, in the same order
+        :rtype: list of UserTastes
+        """
+        first_shards = ndb.get_multi([TasteProfile.shard_key(user.key.id(), 0) for user in users])
+
+        other_keys = [TasteProfile.shard_key(user.key.id(), shard)
+                      for user, first_shard in zip(users, first_shards) if first_shard is not None
+                      for shard in range(1, first_shard.shards)]  # Heavy users, get the other shards together
+        other_shards = dict(zip(other_keys, ndb.get_multi(other_keys))) if len(other_keys) > 0 else {}
+
+        users_tastes = []
+        for user, first_shard in zip(users, first_shards):
+            user_id = user.key.id()
+            if first_shard is None:
+                users_tastes.append(cls.from_legacy(user) if legacy else cls(user_id))
+                continue
+
+            profiles = [first_shard] + [other_shards[TasteProfile.shard_key(user_id, shard)]
+                                        for shard in range(1, first_shard.shards)]
+
+            user_tastes = cls(user_id, first_shard.shards)
+            for profile in profiles:
+                if profile is None:
+                    logging.error("Inconsistence with taste_profile of %s", user_id)
+                    continue
+
+                for kind, item_id, taste, added in zip(profile.kinds, profile.ids, profile.tastes, profile.added):
+                    user_tastes.entries[kind][item_id] = Taste(taste, added)
+
+            users_tastes.append(user_tastes)
+
+        return users_tastes
+
+    @classmethod
+    def from_legacy(cls, user):
+        """
+        Build the tastes of a user from his TasteMovie, TasteArtist and TasteGenre entities, they are not stored.
+        :param user: user
+        :type user: User
+        :return: tastes of the user
+        :rtype: UserTastes
+        """
+        user_tastes = cls(user.key.id())
+        legacy_keys = user.tastes_artists + user.tastes_movies + user.tastes_genres
+
+        if len(legacy_keys) == 0:
+            return user_tastes
+
+        for legacy_taste in ndb.get_multi(legacy_keys):
+            if legacy_taste is None:
+                logging.error("Inconsistence with legacy taste of %s", user.key.id())
+            elif isinstance(legacy_taste, TasteArtist):
+                user_tastes.set("artist", legacy_taste.artist.id(), legacy_taste.taste, legacy_taste.added)
+            elif isinstance(legacy_taste, TasteMovie):
+                user_tastes.set("movie", legacy_taste.movie.id(), legacy_taste.taste, legacy_taste.added)
+            else:
+                user_tastes.set("genre", legacy_taste.genre, legacy_taste.taste, legacy_taste.added)
+
+        return user_tastes
+
+    @classmethod
+    def migrate(cls, user):
+        """
+        Store the tastes of a user read from the old Taste entities, if he has not a TasteProfile yet.
+        :param user: user
+        :type user: User
+        :return: True if the tastes have been migrated
+        :rtype: bool
+        """
+        if len(user.tastes_artists + user.tastes_movies + user.tastes_genres) == 0:
+            return False
+
+        user_tastes = cls.from_legacy(user)
+
+        @ndb.transactional(xg=True, retries=TASTE_TRANSACTION_RETRIES)
+        def store():
+            if TasteProfile.shard_key(user_tastes.user_id, 0).get() is not None:  # Written in the meantime
+                return False
+            user_tastes.put()
+            return True
+
+        if store():
+            logging.info("Migrated the tastes of %s", user_tastes.user_id)
+            return True
+
+        return False
+
+    def copy(self):
+        """
+        Return a copy of the tastes, changing it does not change these ones.
+        :return: copy of the tastes
+        :rtype: UserTastes
+        """
+        user_tastes = UserTastes(self.user_id, self.shards)
+        for kind in TASTE_KINDS:
+            user_tastes.entries[kind] = OrderedDict(self.entries[kind])
+
+        return user_tastes
+
+    def get(self, kind, item_id):
+        """
+        Return the taste about an item.
+        :param kind: kind of the item, one of TASTE_KINDS
+        :type kind: string
+        :param item_id: id of the item
+        :type item_id: string
+        :return: taste or None if there is not
+        :rtype: Taste
+        """
+        return self.entries[kind].get(item_id)
+
+    def set(self, kind, item_id, taste, added):
+        """
+        Set the taste about an item.
+        :param kind: kind of the item, one of TASTE_KINDS
+        :type kind: string
+        :param item_id: id of the item
+        :type item_id: string
+        :param taste: taste to associate to the item
+        :type taste: float
+        :param added: True if the user explicitly added the item
+        :type added: bool
+        :return: None
+        """
+        self.entries[kind][item_id] = Taste(taste, added)
+
+    def remove(self, kind, item_id):
+        """
+        Remove the taste about an item.
+        :param kind: kind of the item, one of TASTE_KINDS
+        :type kind: string
+        :param item_id: id of the item
+        :type item_id: string
+        :return: None
+        """
+        self.entries[kind].pop(item_id, None)
+
+    def items(self, kind):
+        """
+        Return all tastes of a kind in insertion order.
+        :param kind: kind of the items, one of TASTE_KINDS
+        :type kind: string
+        :return: list of (id, taste)
+        :rtype: list of tuple
+        """
+        return self.entries[kind].items()
+
+    def profiles(self):
+        """
+        Build the shards in which store the tastes.
+        :return: shards of the tastes, not stored yet
+        :rtype: list of TasteProfile
+        """
+        rows = [(kind, item_id, taste) for kind in TASTE_KINDS for item_id, taste in self.entries[kind].items()]
+        shards = max(1, (len(rows) + MAX_TASTES_PER_SHARD - 1) // MAX_TASTES_PER_SHARD)
+
+        profiles = []
+        for shard in range(shards):
+            shard_rows = rows[shard * MAX_TASTES_PER_SHARD:(shard + 1) * MAX_TASTES_PER_SHARD]
+            profiles.append(TasteProfile(key=TasteProfile.shard_key(self.user_id, shard),
+                                         kinds=[row[0] for row in shard_rows],
+                                         ids=[row[1] for row in shard_rows],
+                                         tastes=[row[2].taste for row in shard_rows],
+                                         added=[row[2].added for row in shard_rows],
+                                         shards=shards))
+
+        return profiles
+
+    def put(self):
+        """
+        Store the tastes, removing the shards no more needed. The changes of a user go through User.change_taste,
+        which calls it in a transaction.
+        :return: None
+        """
+        profiles = self.profiles()
+        ndb.put_multi(profiles)
+
+        if self.shards > len(profiles):
+            ndb.delete_multi([TasteProfile.shard_key(self.user_id, shard)
+                              for shard in range(len(profiles), self.shards)])
+        self.shards = len(profiles)
+
+    def delete(self):
+        """
+        Delete all the stored tastes.
+        :return: None
+        """
+        ndb.delete_multi([TasteProfile.shard_key(self.user_id, shard) for shard in range(max(1, self.shards))])
+        self.shards = 0
+        self.entries = dict((kind, OrderedDict()) for kind in TASTE_KINDS)
+
+
+MAX_NEIGHBOURS = 20
+
+
+class ItemNeighbours(ndb.Model):
+    """
+    This model represents the most similar artists or movies of an artist or a movie, as found in the tastes of all
+    users. The id is the kind and the IMDb id of the item, see item_key.
+    """
+    neighbours = ndb.StringProperty(repeated=True, indexed=False)
+    similarities = ndb.FloatProperty(repeated=True, indexed=False)
+
+    @staticmethod
+    def item_key(kind, item_id):
+        """
+        Return the key of the neighbours of an item.
+        :param kind: "artist" or "movie"
+        :type kind: string
+        :param item_id: IMDb id of the item
+        :type item_id: string
+        :return: key of the neighbours
+        :rtype: ndb.Key
+        """
+        return ndb.Key(ItemNeighbours, kind + ":" + item_id)
+
+
+class RecordsProperty(ndb.BlobProperty):
+    """
+    Property of a list of dicts with the same fields, stored compact with utilities.encode_records. The values stored
+    as JSON by a JsonProperty before are read too.
+    """
+
+    def __init__(self, fields, tables=(), **kwargs):
+        """
+        Constructor of RecordsProperty.
+        :param fields: usual keys of the dicts
+        :type fields: tuple of string
+        :param tables: fields with values repeated among the dicts
+        :type tables: tuple of string
+        :return: None
+        """
+        super(RecordsProperty, self).__init__(**kwargs)
+        self._fields = fields
+        self._tables = tables
+
+    def _to_base_type(self, value):
+        return encode_records(value, self._fields, self._tables)
+
+    def _from_base_type(self, value):
+        records = decode_records(value)
+        return json.loads(records) if isinstance(records, basestring) else records
+
+
+SCHEDULE_DAYS = 3  # Today, tomorrow and the day after tomorrow
+
+
+class ScheduleDay(ndb.Model):
+    """
+    This model represents the schedule of a tv type for a day, as scraped from FilmTV, see schedule_key.
+    It is the durable copy of the schedule, tv_scheduling keeps it in memcache so ndb does not.
+    """
+    _use_memcache = False
+
+    day = ndb.DateProperty(indexed=False)
+    movies = RecordsProperty(SCHEDULE_FIELDS, SCHEDULE_TABLES)  # As in memcache, the strings keep their type
+
+    @staticmethod
+    def schedule_key(tv_type, day):
+        """
+        Return the key of the schedule of a tv type for a day. The days share SCHEDULE_DAYS keys in rotation, so the
+        schedule of a past day is overwritten and there is nothing to clean.
+        :param tv_type: type of TV, possible value (free, sky, premium)
+        :type tv_type: string
+        :param day: day of the schedule
+        :type day: date
+        :return: key of the schedule
+        :rtype: ndb.Key
+        """
+        return ndb.Key(ScheduleDay, tv_type.lower() + "|" + str(day.toordinal() % SCHEDULE_DAYS))
+
+
+class Proposal(ndb.Model):
+    """
+    This model represents the rendered proposal of a user for a day, see proposal_key.
+    It is valid while the day, the schedule and the tastes of the user are the ones it has been computed with, so a
+    stale proposal is found when read and it does not need to be removed. The proposals of tomorrow, computed the night
+    before, become the ones of today at midnight with nothing to do.
+    """
+    day = ndb.DateProperty(indexed=False)
+    schedule_version = ndb.StringProperty(indexed=False)
+    taste_version = ndb.IntegerProperty(indexed=False)
+    movies = RecordsProperty(PROPOSAL_FIELDS, PROPOSAL_TABLES)
+    scores = ndb.JsonProperty(indexed=False, compressed=True)  # Points and hits of all the movies of the schedule
+
+    @staticmethod
+    def proposal_key(user_id, day):
+        """
+        Return the key of the proposal of a user for a day, the keys rotate as in ScheduleDay.schedule_key.
+        :param user_id: e-mail address of the user
+        :type user_id: string
+        :param day: day of the schedule
+        :type day: date
+        :return: key of the proposal
+        :rtype: ndb.Key
+        """
+        return ndb.Key(Proposal, user_id + "|" + str(day.toordinal() % SCHEDULE_DAYS))
+
+    @staticmethod
+    def user_keys(user_id):
+        """
+        Return the keys of all the proposals of a user.
+        :param user_id: e-mail address of the user
+        :type user_id: string
+        :return: keys of the proposals
+        :rtype: list of ndb.Key
+        """
+        return [ndb.Key(Proposal, user_id + "|" + str(slot)) for slot in range(SCHEDULE_DAYS)]
+
+    def is_valid(self, day, schedule_version, taste_version):
+        """
+        Check if the proposal has been computed with these versions.
+        :param day: day of the schedule
+        :type day: date
+        :param schedule_version: version of the schedule
+        :type schedule_version: string
+        :param taste_version: version of the tastes of the user
+        :type taste_version: int
+        :return: True if it is valid
+        :rtype: bool
+        """
+        return self.day == day and self.schedule_version == schedule_version and self.taste_version == taste_version
+
+
+MAX_TASTE_CHANGES = 50
+
+
+class User(DeferredPut, ModelUtils, ndb.Model):
     """
     This model represents a user.
     The id value is the e-mail address of the user.
@@ -217,7 +1179,9 @@ class User(ModelUtils, ndb.Model):
     tastes_artists = ndb.KeyProperty(TasteArtist, repeated=True)
     tastes_genres = ndb.KeyProperty(TasteGenre, repeated=True)
     tastes_keywords = ndb.KeyProperty(repeated=True)
-    proposal = ndb.JsonProperty()
+    proposal = ndb.JsonProperty()  # Legacy, proposals are stored in Proposal: never read, emptied by _pre_put_hook
+    taste_changes = ndb.JsonProperty(indexed=False)  # Last changes of the tastes, to update the stored scores
+    taste_version = ndb.IntegerProperty(default=0, indexed=False)  # Changed with the tastes or the choices
     language = ndb.StringProperty(choices=["ita", "eng"], default="ita")
 
     tv_type = ndb.StringProperty(choices=TV_TYPE, repeated=True)
@@ -228,6 +1192,13 @@ class User(ModelUtils, ndb.Model):
     tastesJson = ndb.JsonProperty()
     tastesInconsistence = ndb.BooleanProperty(choices=[True, False], default=True)
 
+    def _pre_put_hook(self):
+        """
+        Empty the legacy proposal of the old entities when they are written.
+        :return: None
+        """
+        self.proposal = None
+        super(User, self)._pre_put_hook()
 
     def add_watched_movie(self, movie, date):
         """
@@ -238,11 +1209,51 @@ class User(ModelUtils, ndb.Model):
         :type date: date
         :return: None
         """
-        if movie.key not in self.watched_movies:
+        if movie.key.id() not in self.watched:
             self.watched_movies.append(movie.key)
             self.date_watched.append(date)
+            self.watched.add(movie.key.id())
+            if self.repeat_choice is not True:  # The proposal could have it
+                self.remove_proposal()
             self.put()
 
+    @property
+    def watched(self):
+        """
+        Property that returns the ids of the watched movies as a set, it is built once and kept up to date by
+        add_watched_movie.
+        :return: ids of the watched movies
+        :rtype: set of string
+        """
+        if getattr(self, '_watched', None) is None:
+            self._watched = set(key.id() for key in self.watched_movies)
+
+        return self._watched
+
+    @property
+    def tastes(self):
+        """
+        Property that returns all the tastes of the user, they are loaded once.
+        :return: tastes of the user
+        :rtype: UserTastes
+        """
+        if getattr(self, '_tastes', None) is None:
+            self._tastes = UserTastes.load(self)
+
+        return self._tastes
+
+    @staticmethod
+    def load_tastes(users):
+        """
+        Load together the tastes of many users, the ones already loaded are kept.
+        :param users: users
+        :type users: list of User
+        :return: None
+        """
+        users = [user for user in users if getattr(user, '_tastes', None) is None]
+        for user, user_tastes in zip(users, UserTastes.load_multi(users)):
+            user._tastes = user_tastes
+
     def add_taste_movie(self, movie, taste=1.0):
         """
         Add user's taste of a movie.
@@ -252,22 +1263,10 @@ class User(ModelUtils, ndb.Model):
         :type taste: float
         :return: None
         """
-        # TODO: improve, I don't know if it is the best way to see if there is yet TasteArtist
-        taste_movie = TasteMovie(id=(movie.key.id() + self.key.id()),  # Create the user's taste with unique id
-                                 taste=taste)
-
-        if taste == 1.0:
-            taste_movie.added = True
-
-        taste_movie.add_movie(movie)
-        taste_movie_key = taste_movie.put()
+        self.change_taste("movie", movie.key.id(), lambda current: Taste(taste, taste == 1.0))
 
-        if taste_movie_key not in self.tastes_movies:
-            self.tastes_movies.append(taste_movie_key)  # Append the taste to user's tastes
-            self.put()
-
-        taskqueue.add(url='/_ah/start/task/movie_tastes/' + self.key.id() +
-                          '/' + movie.key.id() + '/' + str(taste), method='GET')
+        add_task(url='/_ah/start/task/movie_tastes/' + self.key.id() +
+                     '/' + movie.key.id() + '/' + str(taste), method='GET')
 
     def add_taste_artist(self, artist, taste=1.0):
         """
@@ -278,120 +1277,157 @@ class User(ModelUtils, ndb.Model):
         :type taste: float
         :return: None
         """
-        taste_artist = TasteArtist.get_by_id(artist.key.id() + self.key.id())
-        if taste_artist is None:
-            taste_artist = TasteArtist(id=(artist.key.id() + self.key.id()),
-                                       taste=taste)  # Create the user's taste with unique id
-
-            if taste == 1.0:
-                taste_artist.added = True
-
-            taste_artist.add_artist(artist)
-            taste_artist_key = taste_artist.put()
-
-            if taste_artist_key not in self.tastes_artists:
-                self.tastes_artists.append(taste_artist_key)  # Append the taste to user's tastes
-                self.put()
-        else:
-            if taste == 1:
-                taste_artist.added = True
-
-            taste_artist.update_taste(taste)
-
-        # Recalculate proposal
-        self.remove_proposal()
+        self.change_taste("artist", artist.key.id(), lambda current: increased_taste(current, taste))
 
     def add_taste_genre(self, genre, taste=1.0):
         logging.info("genre added")
         if genre in GENRES:
-            taste_genre = TasteGenre.get_by_id(genre + self.key.id())
-            if taste_genre is None:
-                taste_genre = TasteGenre(id=(genre + self.key.id()),
-                                         genre=genre,
-                                         taste=taste)
-
-                if taste == 1.0:
-                    taste_genre.added = True
-
-                taste_genre_key = taste_genre.put()
-
-                if taste_genre_key not in self.tastes_genres:
-                    self.tastes_genres.append(taste_genre_key)
-                    self.put()
-            else:
-                if taste == 1:
-                    taste_genre.added = True
-
-                taste_genre.update_taste(taste)
-
-        # Recalculate proposal
-        self.remove_proposal()
+            self.change_taste("genre", genre, lambda current: increased_taste(current, taste))
 
     def remove_taste_movie(self, movie):
         """
-
-        :param movie:
-        :return:
+        Remove user's taste of a movie.
+        :param movie: movie to remove
+        :type movie: Movie
+        :return: None
         """
-        taste_movie_id = movie.key.id() + self.key.id()
-        taste_movie = TasteMovie.get_by_id(taste_movie_id)
-
-        if taste_movie is not None:
-            taste_movie_key = taste_movie.key
+        if self.tastes.get("movie", movie.key.id()) is not None:
+            self.change_taste("movie", movie.key.id(), lambda current: None)
 
+        add_task(url='/_ah/start/task/movie_untaste/' + self.key.id() +
+                     '/' + movie.key.id(), method='GET')  # It updates the proposal with the artists and the genres
 
+    def remove_taste_artist(self, artist):
+        """
+        Remove user's taste of an artist, if the artist has got a taste also from movies only the added one is removed.
+        :param artist: artist to remove
+        :type artist: Artist
+        :return: None
+        """
+        self.remove_taste("artist", artist.key.id())
 
-            taste_movie.key.delete()
-            if taste_movie_key in self.tastes_movies:
-                self.tastes_movies.remove(taste_movie_key)
-                self.put()
+    def remove_taste_genre(self, genre):
+        """
+        Remove user's taste of a genre, if the genre has got a taste also from movies only the added one is removed.
+        :param genre: genre to remove
+        :type genre: string
+        :return: None
+        """
+        self.remove_taste("genre", genre)
 
-        taskqueue.add(url='/_ah/start/task/movie_untaste/' + self.key.id() +
-                          '/' + movie.key.id(), method='GET')
+    def remove_taste(self, kind, item_id):
+        """
+        Remove the taste of an artist or a genre.
+        :param kind: "artist" or "genre"
+        :type kind: string
+        :param item_id: IMDb id of the artist or name of the genre
+        :type item_id: string
+        :return: None
+        """
+        if self.tastes.get(kind, item_id) is None:
+            logging.error("Inconsistence with taste_%s", kind)
+            return
 
-        # Recalculate proposal
-        self.remove_proposal()
+        self.change_taste(kind, item_id, decreased_taste)
 
-    def remove_taste_artist(self, artist):
+    def change_taste(self, kind, item_id, change):
         """
-
-        :param artist:
-        :return:
+        Change a taste of the user and log it for the stored proposals. The change is applied at once to the loaded
+        tastes and again to the stored ones when they are written, see store_tastes.
+        :param kind: kind of the item, one of TASTE_KINDS, None to only bump the version of the tastes
+        :type kind: string
+        :param item_id: id of the item
+        :type item_id: string
+        :param change: function from the current taste, or None, to the new one, or None to remove it
+        :type change: function
+        :return: None
         """
-        taste_artist_id = artist.key.id() + self.key.id()
-        taste_artist = TasteArtist.get_by_id(taste_artist_id)
-        if (taste_artist.taste > 0.99 and taste_artist.taste <= 1) or taste_artist.taste == 0:
-            taste_artist_key = taste_artist.key
+        self.apply_taste_change(self.tastes if kind is not None else None, kind, item_id, change)
 
-            taste_artist.key.delete()
-            if taste_artist_key in self.tastes_artists:
-                self.tastes_artists.remove(taste_artist_key)
-                self.put()
-        elif taste_artist.taste > 1:
-            taste_artist.added = False
-            taste_artist.update_taste(-1)
+        if getattr(self, '_pending_taste_changes', None) is None:
+            self._pending_taste_changes = []
+        self._pending_taste_changes.append((kind, item_id, change))
+        add_transaction(self.key, self.store_tastes)  # Once at the end of the request
 
-        # Recalculate proposal
-        self.remove_proposal()
+    def apply_taste_change(self, tastes, kind, item_id, change):
+        """
+        Apply a change to tastes of the user and log it.
+        :param tastes: tastes of the user, None if kind is None
+        :type tastes: UserTastes
+        :param kind: kind of the item, one of TASTE_KINDS, None to only bump the version of the tastes
+        :type kind: string
+        :param item_id: id of the item
+        :type item_id: string
+        :param change: function from the current taste, or None, to the new one, or None to remove it
+        :type change: function
+        :return: None
+        """
+        if kind is None:
+            self.record_taste_change()
+            return
+
+        current = tastes.get(kind, item_id)
+        new = change(current)
+        if new is None:
+            tastes.remove(kind, item_id)
+        else:
+            tastes.set(kind, item_id, new.taste, new.added)
 
-    def remove_taste_genre(self, genre):
-        taste_genre_id = genre + self.key.id()
-        taste_genre = TasteGenre.get_by_id(taste_genre_id)
-        if (taste_genre.taste > 0.99 and taste_genre.taste <= 1) or taste_genre.taste == 0:
-            taste_genre_key = taste_genre.key
-
-            taste_genre.key.delete()
-            if taste_genre_key in self.tastes_genres:
-                self.tastes_genres.remove(taste_genre_key)
-                self.put()
-        elif taste_genre.taste > 1:
-            taste_genre.added = False
-            taste_genre.update_taste(-1)
-        self.proposal = None
-        self.put()
+        if kind != "movie" and new != current:  # Only artists and genres are in the scores
+            delta = (new.taste if new is not None else 0) - (current.taste if current is not None else 0)
+            self.record_taste_change(kind, item_id, delta, (new is not None) - (current is not None))
 
-        # Recalculate proposal
-        self.remove_proposal()
+    def store_tastes(self):
+        """
+        Write the taste changes of the user in a transaction that applies them again to the stored user and tastes, so
+        the ones made at the same time by other requests are kept. If the user is waiting to be written, he is written
+        in the transaction with his other changes.
+        :return: None
+        """
+        changes = getattr(self, '_pending_taste_changes', None) or []
+        self._pending_taste_changes = None
+        if len(changes) == 0:
+            return
+
+        deferred = is_deferred(self.key)
+        with_tastes = any(kind is not None for kind, item_id, change in changes)
+        legacy = None
+        if with_tastes and self.tastes.shards == 0:  # Read out of the transaction, they are many entity groups
+            legacy = UserTastes.from_legacy(self)
+
+        @ndb.transactional(xg=True, retries=TASTE_TRANSACTION_RETRIES)
+        def store():
+            user = self.key.get()
+            if user is None:  # Unsubscribed in the meantime
+                return None
+
+            tastes = None
+            if with_tastes:
+                tastes = UserTastes.load_multi([user], legacy=False)[0]
+                if tastes.shards == 0 and legacy is not None:
+                    tastes = legacy.copy()
+
+            for kind, item_id, change in changes:
+                user.apply_taste_change(tastes, kind, item_id, change)
+
+            if deferred:
+                self.taste_version, self.taste_changes = user.taste_version, user.taste_changes
+                user = self
+            ndb.put_multi([user])  # Not deferred
+            if tastes is not None:
+                tastes.put()
+
+            return user, tastes
+
+        stored = store()
+        if stored is None:
+            logging.warning("User %s removed before writing his tastes", self.key.id())
+            return
+
+        user, tastes = stored
+        self.taste_version, self.taste_changes = user.taste_version, user.taste_changes
+        if tastes is not None:
+            self._tastes = tastes
 
     def add_tv_type(self, type):
         """
@@ -453,6 +1489,7 @@ class User(ModelUtils, ndb.Model):
         else:
             return False
 
+        self.remove_proposal()  # The watched movies are proposed or not
         self.put()
         return True
 
@@ -482,11 +1519,43 @@ class User(ModelUtils, ndb.Model):
 
     def remove_proposal(self):
         """
+        Bump the version of the tastes, so the stored proposals of the user are not valid anymore.
+        :return: None
+        """
+        self.change_taste(None, None, None)
 
-        :return:
+    def record_taste_change(self, kind=None, item_id=None, delta=0, tasted=0):
         """
-        self.proposal = None
-        self.put()
+        Bump the version of the tastes and log the change, without kind if the scores are not changed. Only the last
+        MAX_TASTE_CHANGES are kept, older proposals are computed again.
+        :param kind: "artist" or "genre", None if the scores are not changed
+        :type kind: string
+        :param item_id: IMDb id of the artist or name of the genre
+        :type item_id: string
+        :param delta: change of the taste
+        :type delta: float
+        :param tasted: 1 if the taste has been added, -1 if it has been removed, 0 otherwise
+        :type tasted: int
+        :return: None
+        """
+        self.taste_version += 1
+        changes = self.taste_changes if self.taste_changes is not None else []
+        changes.append([self.taste_version, kind, item_id, delta, tasted])
+        self.taste_changes = changes[-MAX_TASTE_CHANGES:]
+
+    def changes_since(self, taste_version):
+        """
+        Return the changes of the tastes after a version.
+        :param taste_version: version of the tastes
+        :type taste_version: int
+        :return: changes, as [kind, id, change of the taste, tasted], None if some of them are not logged
+        :rtype: list of list
+        """
+        changes = [change for change in (self.taste_changes or []) if change[0] > taste_version]
+        if len(changes) != self.taste_version - taste_version:
+            return None
+
+        return [change[1:] for change in changes if change[1] is not None]
 
 
 
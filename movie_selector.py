@@ -1,10 +1,22 @@
+import hashlib
+import heapq
+import itertools
 import logging
+import math
 import random
+from collections import Counter, defaultdict
+from datetime import date
+import numpy as np
 from google.appengine.ext import ndb
-from models import TasteMovie, TasteArtist, TasteGenre, User, Movie
+from models import User, Movie, Proposal, ItemNeighbours, MAX_NEIGHBOURS, get_schedule_movies
 
-from tv_scheduling import result_movies_schedule
-from utilities import NUMBER_SUGGESTIONS
+from tv_scheduling import result_movies_schedule, result_movies_schedules, result_schedule_indexes, \
+    store_schedule_index, schedule_date
+from utilities import NUMBER_SUGGESTIONS, channel_number
+
+MAX_LIKED_ITEMS = 50  # Items of every kind of a user counted for the neighbours
+
+MIN_COOCCURRENCES = 2
 
 
 def random_movie_selection(schedule_movies):
@@ -18,100 +30,678 @@ def random_movie_selection(schedule_movies):
     return random.choice(schedule_movies)
 
 
-def taste_based_movie_selection(user, schedule_movies):
-    """
-
-    :param user:
-    :param schedule_movies:
-    :return:
-    """
-    tastes_artists_id = user.tastes_artists  # Get all taste_artists' keys
-    tastes_movies_id = user.tastes_movies
-    tastes_genres_id = user.tastes_genres
-
-    artists_id = []
-    artists_value = []
-    for taste_artist_id in tastes_artists_id:
-        taste_artist = TasteArtist.get_by_id(taste_artist_id.id())  # Get taste
-        if taste_artist is not None:
-            artist_id = taste_artist.artist.id()  # Get movie id from taste
-            artists_id.append(artist_id)
-            artists_value.append(taste_artist.taste)
-        else:
-            logging.error("Inconsistence with taste_artist")
-
-    movies_id = []
-    movies_value = []
-    for taste_movie_id in tastes_movies_id:
-        taste_movie = TasteMovie.get_by_id(taste_movie_id.id())  # Get taste
-        if taste_movie is not None:
-            movie_id = taste_movie.movie.id()  # Get movie id from taste
-            movies_id.append(movie_id)
-            movies_value.append(taste_movie.taste)
-        else:
-            logging.error("Inconsistence with taste_movie")
-
-    genres = []
-    genres_value = []
-    for taste_genre_id in tastes_genres_id:
-        taste_genre = TasteGenre.get_by_id(taste_genre_id.id())
-        if taste_genre is not None:
-            genres.append(taste_genre.genre)
-            genres_value.append(taste_genre.taste)
-        else:
-            logging.error("Inconsistence with taste_genre")
+class ScheduleFeatures(object):
+    """
+    Sparse matrix, in CSR format, of the movies of a schedule by their features (artists and genres). It is built once
+    for the schedule and every user is scored against it with a weight vector of his tastes.
+    A row has an element for every credit of the movie (actors, directors, writers and then genres), so an artist who
+    is both director and writer of a movie counts twice, as before.
+    The columns are indexed by kind and id, this inverted index is stored when the movies of the schedule are
+    retrieved, so the scoring does not need to read the movies.
+    """
 
-    data = []
-    random_choice = True
+    def __init__(self, schedule_movies, movie_ids, indptr, indices, features, positions=None, movies=None):
+        """
+        Constructor of ScheduleFeatures.
+        :param schedule_movies: movies of the schedule found in the datastore, one for every row
+        :type schedule_movies: list of dict
+        :param movie_ids: id of the movie of every row
+        :type movie_ids: list of string
+        :param indptr: start of every row in indices, and the end of the last one
+        :type indptr: list of int
+        :param indices: column of every element
+        :type indices: list of int
+        :param features: (kind, id) of every column
+        :type features: list of tuple
+        :param positions: position in the schedule of every row, None if it is not a single schedule
+        :type positions: list of int
+        :param movies: movies already read, by id
+        :type movies: dict
+        :return: None
+        """
+        self.schedule_movies = schedule_movies
+        self.movie_ids = movie_ids
+        self.indptr = np.array(indptr, dtype=np.int32)
+        self.indices = np.array(indices, dtype=np.int32)
+        self.rows = np.repeat(np.arange(len(movie_ids), dtype=np.int32), np.diff(self.indptr))  # Row of every element
+        self.features = features
+        self.positions = positions
+        self.movies = movies if movies is not None else {}
 
-    repeatChoice = user.repeat_choice
+        self.columns = {"artist": {}, "genre": {}}  # kind -> id -> column
+        for column, (kind, item_id) in enumerate(features):
+            self.columns[kind][item_id] = column
 
-    for movie in schedule_movies:
-        points = 0.0
-        movie_data_store = Movie.query(ndb.OR(Movie.original_title == movie["originalTitle"],
-                                              Movie.title == movie["title"])).get()
+        self.version = self.schedule_version(schedule_movies, movie_ids)
+        self.neighbours = None  # (kind, id) -> [(neighbour id, similarity)], read when needed
+        self.day = None  # Date of the schedule, set by for_tv_types
 
-        if movie_data_store is not None:
-            if repeatChoice is not True and movie_data_store.key in user.watched_movies:
-                logging.info("Movie already watched: " + movie_data_store.key.id())
-                continue
+    @staticmethod
+    def schedule_version(schedule_movies, movie_ids):
+        """
+        Return the version of the schedule, it changes with its movies and with their channel and time, as shown in the
+        proposals.
+        :param schedule_movies: movies of the schedule, one for every row
+        :type schedule_movies: list of dict
+        :param movie_ids: id of the movie of every row
+        :type movie_ids: list of string
+        :return: version
+        :rtype: string
+        """
+        digest = hashlib.md5()
+        for movie, movie_id in zip(schedule_movies, movie_ids):
+            for value in (movie_id, movie["channel"], movie["time"]):
+                digest.update(value.encode('utf-8') if isinstance(value, unicode) else str(value))
+                digest.update("\n")
 
-            for actor in movie_data_store.actors:
-                if actor.get().key.id() in artists_id:
-                    logging.info("Trovato %s", str(actor.get().key.id()))
-                    points += artists_value[artists_id.index(actor.get().key.id())]
-                    random_choice = False
+        return digest.hexdigest()
 
-            for director in movie_data_store.directors:
-                if director.get().key.id() in artists_id:
-                    logging.info("Trovato %s", str(director.get().key.id()))
-                    points += artists_value[artists_id.index(director.get().key.id())]
-                    random_choice = False
+    @classmethod
+    def from_schedule(cls, schedule_movies, movies_data_store=None):
+        """
+        Build the features of a schedule, finding all its movies together.
+        :param schedule_movies: movies schedule
+        :type schedule_movies: list of dict
+        :param movies_data_store: movies of the schedule in the datastore, None if not found
+        :type movies_data_store: list of Movie
+        :return: features of the schedule
+        :rtype: ScheduleFeatures
+        """
+        if movies_data_store is None:
+            movies_data_store = get_schedule_movies(schedule_movies)
 
-            for writer in movie_data_store.writers:
-                if writer.get().key.id() in artists_id:
-                    logging.info("Trovato %s", str(writer.get().key.id()))
-                    points += artists_value[artists_id.index(writer.get().key.id())]
-                    random_choice = False
+        rows_movies = []
+        movie_ids = []
+        positions = []
+        movies = {}
+        columns = {}
+        indptr = [0]
+        indices = []
+        for position, (movie, movie_data_store) in enumerate(zip(schedule_movies, movies_data_store)):
+            if movie_data_store is None:
+                logging.error("Non presente nel datastore: %s", (str(movie["originalTitle"]) if movie["originalTitle"] is not None else str(movie["title"])))
+                continue
 
+            for artist in movie_data_store.actors + movie_data_store.directors + movie_data_store.writers:
+                indices.append(columns.setdefault(("artist", artist.id()), len(columns)))
             for genre in movie_data_store.genres:
-                if genre in genres:
-                    logging.info("Trovato %s", genre)
-                    points += genres_value[genres.index(genre)]
-                    random_choice = False
+                indices.append(columns.setdefault(("genre", genre), len(columns)))
+
+            indptr.append(len(indices))
+            rows_movies.append(movie)
+            movie_ids.append(movie_data_store.key.id())
+            positions.append(position)
+            movies[movie_data_store.key.id()] = movie_data_store
+
+        features = sorted(columns, key=columns.get)
+        return cls(rows_movies, movie_ids, indptr, indices, features, positions, movies)
+
+    @classmethod
+    def from_index(cls, index, schedule_movies):
+        """
+        Build the features of a schedule from its stored index.
+        :param index: index of the schedule, as returned by to_index
+        :type index: dict
+        :param schedule_movies: movies schedule
+        :type schedule_movies: list of dict
+        :return: features of the schedule or None if the index is not about this schedule
+        :rtype: ScheduleFeatures
+        """
+        if index["length"] != len(schedule_movies):
+            return None
+        urls = index.get("urls") or [None] * len(index["positions"])  # Missing in the old indexes
+        for position, movie_id, url in zip(index["positions"], index["ids"], urls):
+            movie = schedule_movies[position]
+            if movie.get("idIMDB") is not None:  # Found by id
+                found = movie["idIMDB"] == movie_id
+            else:  # Found by title
+                found = url is not None and movie.get("movieUrl") == url
+            if not found:  # Schedule changed after the index was built
+                return None
+
+        return cls([schedule_movies[position] for position in index["positions"]], index["ids"], index["indptr"],
+                   index["indices"], index["features"], index["positions"])
+
+    def to_index(self, length):
+        """
+        Return the index to store.
+        :param length: number of movies of the schedule, found or not
+        :type length: int
+        :return: index
+            {"length": length, "positions": [position], "ids": [id], "urls": [url], "indptr": [int],
+            "indices": [int], "features": [(kind, id)]}
+        :rtype: dict
+        """
+        return {"length": length, "positions": self.positions, "ids": self.movie_ids,
+                "urls": [movie.get("movieUrl") for movie in self.schedule_movies], "indptr": self.indptr.tolist(),
+                "indices": self.indices.tolist(), "features": self.features}
+
+    @classmethod
+    def from_schedule_index(cls, tv_type, day, schedule_movies, index):
+        """
+        Return the features of a schedule from its index, building (and storing) it if missing or stale.
+        :param tv_type: type of TV, possible value (free, sky, premium)
+        :type tv_type: string
+        :param day: interested day, possible value (today, tomorrow, future)
+        :type day: string
+        :param schedule_movies: movies schedule
+        :type schedule_movies: list of dict
+        :param index: stored index of the schedule, None if missing
+        :type index: dict
+        :return: features of the schedule
+        :rtype: ScheduleFeatures
+        """
+        features = cls.from_index(index, schedule_movies) if index is not None else None
+        if features is None:
+            features = cls.build(tv_type, day, schedule_movies)
+
+        return features
+
+    @classmethod
+    def build(cls, tv_type, day, schedule_movies):
+        """
+        Build the features of a schedule and store its index.
+        :param tv_type: type of TV, possible value (free, sky, premium)
+        :type tv_type: string
+        :param day: interested day, possible value (today, tomorrow, future)
+        :type day: string
+        :param schedule_movies: movies schedule
+        :type schedule_movies: list of dict
+        :return: features of the schedule
+        :rtype: ScheduleFeatures
+        """
+        features = cls.from_schedule(schedule_movies)
+        store_schedule_index(tv_type, day, features.to_index(len(schedule_movies)))
+
+        return features
+
+    @classmethod
+    def for_tv_types(cls, tv_type_list, day="today"):
+        """
+        Return the features of the schedules of many tv types, as if they were a single schedule. The schedules and
+        their indexes are read together and the missing schedules are retrieved concurrently.
+        :param tv_type_list: list of tv types
+        :type tv_type_list: list of string
+        :param day: interested day, possible value (today, tomorrow, future)
+        :type day: string
+        :return: features of the schedules
+        :rtype: ScheduleFeatures
+        """
+        if len(tv_type_list) == 0:
+            logging.info("no tv type set")
+            tv_type_list = ["free"]
+
+        schedules = result_movies_schedules(tv_type_list, day)
+        indexes = result_schedule_indexes(tv_type_list, day)
+        features = cls.concatenate([cls.from_schedule_index(tv_type, day, schedule_movies, index) for
+                                    tv_type, schedule_movies, index in zip(tv_type_list, schedules, indexes)])
+        features.day = schedule_date(day)
+        return features
+
+    @classmethod
+    def concatenate(cls, parts):
+        """
+        Join the features of many schedules, the rows keep their order.
+        :param parts: features of the schedules
+        :type parts: list of ScheduleFeatures
+        :return: features of all the schedules
+        :rtype: ScheduleFeatures
+        """
+        if len(parts) == 1:
+            return parts[0]
+
+        schedule_movies = []
+        movie_ids = []
+        movies = {}
+        features = []
+        columns = {}
+        indptr = [np.zeros(1, dtype=np.int32)]
+        indices = []
+        elements = 0
+        for part in parts:
+            remap = []
+            for feature in part.features:
+                if feature not in columns:
+                    columns[feature] = len(features)
+                    features.append(feature)
+                remap.append(columns[feature])
+
+            indptr.append(part.indptr[1:] + elements)
+            indices.append(np.array(remap, dtype=np.int32)[part.indices])
+            elements += len(part.indices)
+            schedule_movies += part.schedule_movies
+            movie_ids += part.movie_ids
+            movies.update(part.movies)
+
+        return cls(schedule_movies, movie_ids, np.concatenate(indptr), np.concatenate(indices), features,
+                   movies=movies)
+
+    def get_movies(self, rows):
+        """
+        Return the movies of some rows, reading together the ones not read yet.
+        :param rows: rows of the movies
+        :type rows: list of int
+        :return: movies, None if no more in the datastore
+        :rtype: list of Movie
+        """
+        missing = [self.movie_ids[row] for row in rows if self.movie_ids[row] not in self.movies]
+        if len(missing) > 0:
+            self.movies.update(zip(missing, ndb.get_multi([ndb.Key(Movie, movie_id) for movie_id in missing])))
+
+        return [self.movies[self.movie_ids[row]] for row in rows]
+
+    def weights(self, tastes):
+        """
+        Build the weight vector of the tastes of a user. For every kind it walks the smaller between the tastes of the
+        user and the features of the schedule, so tastes that cannot contribute cost nothing.
+        :param tastes: tastes of the user
+        :type tastes: UserTastes
+        :return: weights and mask of the features tasted
+        :rtype: tuple of numpy.ndarray
+        """
+        weights = np.zeros(len(self.features))
+        tasted = np.zeros(len(self.features), dtype=bool)
+        for kind, columns in self.columns.items():
+            entries = tastes.entries[kind]
+            if len(entries) <= len(columns):
+                overlap = [(columns[item_id], taste) for item_id, taste in entries.items() if item_id in columns]
+            else:
+                overlap = [(column, entries[item_id]) for item_id, column in columns.items() if item_id in entries]
+
+            for column, taste in overlap:
+                weights[column] = taste.taste
+                tasted[column] = True
+
+        return weights, tasted
+
+    def sum_rows(self, rows, weights=None):
+        """
+        Sum some weights by the rows of the movies, for every movie of the schedule. Numpy 1.6 bincount does not accept
+        empty rows nor a minlength of 0, so an empty schedule, or one without features, is summed here.
+        :param rows: rows of the weights
+        :type rows: numpy.ndarray
+        :param weights: weights, 1 if None
+        :type weights: numpy.ndarray
+        :return: sum of every movie
+        :rtype: numpy.ndarray
+        """
+        if len(rows) == 0:
+            return np.zeros(len(self.movie_ids))
+
+        return np.bincount(rows, weights=weights, minlength=len(self.movie_ids))
+
+    def score(self, tastes):
+        """
+        Score all the movies of the schedule with the tastes of a user.
+        :param tastes: tastes of the user
+        :type tastes: UserTastes
+        :return: points of every movie and for every movie the number of its features tasted
+        :rtype: tuple of numpy.ndarray
+        """
+        weights, tasted = self.weights(tastes)
+        points = self.sum_rows(self.rows, weights[self.indices])
+        hits = self.sum_rows(self.rows, tasted[self.indices])
+
+        return points, hits
+
+    def apply(self, points, hits, deltas):
+        """
+        Update the scores of the movies with some changes of the tastes, only the movies with the feature changed are
+        touched.
+        :param points: points of every movie
+        :type points: numpy.ndarray
+        :param hits: number of features tasted of every movie
+        :type hits: numpy.ndarray
+        :param deltas: changes of the tastes, as [kind, id, change of the taste, 1 if added, -1 if removed, else 0]
+        :type deltas: list of list
+        :return: points and hits updated
+        :rtype: tuple of numpy.ndarray
+        """
+        for kind, item_id, delta, tasted in deltas:
+            column = self.columns[kind].get(item_id)
+            if column is None:  # Not in the schedule, it cannot contribute
+                continue
+
+            counts = self.sum_rows(self.rows[self.indices == column])
+            points += delta * counts
+            hits += tasted * counts
+
+        return points, hits
+
+    def load_neighbours(self):
+        """
+        Read together the neighbours of the artists and of the movies of the schedule.
+        :return: None
+        """
+        items = [("artist", item_id) for item_id in self.columns["artist"]] + [("movie", movie_id)
+                                                                               for movie_id in set(self.movie_ids)]
+        self.neighbours = {}
+        for item, item_neighbours in zip(items, ndb.get_multi([ItemNeighbours.item_key(kind, item_id)
+                                                                for kind, item_id in items])):
+            if item_neighbours is not None:
+                self.neighbours[item] = zip(item_neighbours.neighbours, item_neighbours.similarities)
+
+    def neighbour_score(self, tastes):
+        """
+        Score all the movies of the schedule with the tastes of a user about the neighbours of their artists and of
+        the movies themselves. It is used when no feature of the schedule has been tasted.
+        :param tastes: tastes of the user
+        :type tastes: UserTastes
+        :return: points of every movie
+        :rtype: numpy.ndarray
+        """
+        if self.neighbours is None:
+            self.load_neighbours()
+
+        def similar_taste(kind, item_id):
+            entries = tastes.entries[kind]
+            return sum(similarity * entries[neighbour].taste
+                       for neighbour, similarity in self.neighbours.get((kind, item_id), ()) if neighbour in entries)
+
+        weights = np.zeros(len(self.features))
+        for item_id, column in self.columns["artist"].items():
+            weights[column] = similar_taste("artist", item_id)
+
+        points = self.sum_rows(self.rows, weights[self.indices])
+        for row, movie_id in enumerate(self.movie_ids):
+            points[row] += similar_taste("movie", movie_id)
+
+        return points
+
+
+class CooccurrenceCounter(object):
+    """
+    Count how many users like every artist and every movie, and every pair of them, to find the neighbours of the
+    items. The similarity of two items is their cosine: users who like both / sqrt(users who like the first * users
+    who like the second).
+    """
+
+    def __init__(self):
+        """
+        Constructor of CooccurrenceCounter.
+        :return: None
+        """
+        self.items = Counter()  # (kind, id) -> users
+        self.pairs = defaultdict(Counter)  # (kind, id) -> id -> users
+
+    def add(self, tastes):
+        """
+        Count the tastes of a user, only the MAX_LIKED_ITEMS artists and movies he likes most.
+        :param tastes: tastes of the user
+        :type tastes: UserTastes
+        :return: None
+        """
+        for kind in ("artist", "movie"):
+            liked = heapq.nlargest(MAX_LIKED_ITEMS, [(taste.taste, item_id) for item_id, taste in tastes.items(kind)
+                                                     if taste.taste > 0])
+            liked = [item_id for taste, item_id in liked]
+
+            for item_id in liked:
+                self.items[(kind, item_id)] += 1
+            for first, second in itertools.combinations(liked, 2):
+                self.pairs[(kind, first)][second] += 1
+                self.pairs[(kind, second)][first] += 1
+
+    def neighbours(self):
+        """
+        Return the MAX_NEIGHBOURS most similar items of every item, liked together by at least MIN_COOCCURRENCES users.
+        :return: neighbours, not stored yet
+        :rtype: list of ItemNeighbours
+        """
+        items_neighbours = []
+        for (kind, item_id), counts in self.pairs.items():
+            similarities = [(count / math.sqrt(self.items[(kind, item_id)] * self.items[(kind, other)]), other)
+                            for other, count in counts.items() if count >= MIN_COOCCURRENCES]
+            if len(similarities) == 0:
+                continue
+
+            top = heapq.nlargest(MAX_NEIGHBOURS, similarities)
+            items_neighbours.append(ItemNeighbours(key=ItemNeighbours.item_key(kind, item_id),
+                                                   neighbours=[other for similarity, other in top],
+                                                   similarities=[similarity for similarity, other in top]))
+
+        return items_neighbours
+
+
+def count_rankable(user, features):
+    """
+    Return the number of movies of the schedule that rank_movies ranks for the user, the watched ones are not if the
+    user does not want them again.
+    :param user: user
+    :type user: User
+    :param features: features of the schedule
+    :type features: ScheduleFeatures
+    :return: number of movies
+    :rtype: int
+    """
+    if user.repeat_choice is True:
+        return len(features.movie_ids)
+
+    watched = user.watched
+    return sum(1 for movie_id in features.movie_ids if movie_id not in watched)
 
-            logging.info("Titolo: %s - Punteggio: %6.2f", movie_data_store.original_title, points)
 
-            data.append((movie, points))
-        else:
-            logging.error("Non presente nel datastore: %s", (str(movie["originalTitle"]) if movie["originalTitle"] is not None else str(movie["title"])))
+def rank_movies(user, features, limit=None, scores=None):
+    """
+    Rank the movies of the schedule with the tastes of the user. If no movie has something the user tasted, they are
+    ranked with the neighbours of their artists and of the movies themselves, at random if neither those are tasted.
+    The random order is the same for the user and the day of the schedule, so the pages of the ranking are consistent.
+    :param user: user
+    :type user: User
+    :param features: features of the schedule
+    :type features: ScheduleFeatures
+    :param limit: number of best movies to return, None for all
+    :type limit: int
+    :param scores: points and hits of the movies if already computed
+    :type scores: tuple of numpy.ndarray
+    :return: ranked movies, as index of the movie in the features and points
+    :rtype: list of tuple (int, float)
+    """
+    if scores is None:
+        scores = features.score(user.tastes)  # Get all tastes with one or two reads
+    points, hits = scores
+
+    data = []
+    random_choice = True
+
+    repeatChoice = user.repeat_choice
+    watched = user.watched if repeatChoice is not True else ()
+
+    for i, movie_id in enumerate(features.movie_ids):
+        if movie_id in watched:
+            logging.info("Movie already watched: " + movie_id)
+            continue
+
+        if hits[i] > 0:
+            random_choice = False
+
+        logging.info("Titolo: %s - Punteggio: %6.2f", features.schedule_movies[i]["title"], points[i])
+
+        data.append((i, float(points[i])))
+
+    if random_choice:  # Try with the neighbours
+        points = features.neighbour_score(user.tastes)
+        if any(points[i] != 0 for i, old_points in data):
+            data = [(i, float(points[i])) for i, old_points in data]
+            random_choice = False
 
     if random_choice:
-        random.shuffle(data)
-    else:
+        day = features.day if features.day is not None else date.today()
+        random.Random(user.key.id() + day.isoformat()).shuffle(data)
+    elif limit is None:
         data.sort(key=lambda tup: tup[1], reverse=True)
+    else:
+        data = heapq.nlargest(limit, data, key=lambda tup: tup[1])  # Same as sorting, without sorting all
+
+    return data if limit is None else data[:limit]
+
+
+def taste_based_movie_selection(user, schedule_movies, features=None):
+    """
+    Rank the movies of the schedule with the tastes of the user, at random if no movie has something the user tasted.
+    :param user: user
+    :type user: User
+    :param schedule_movies: movies schedule
+    :type schedule_movies: list of dict
+    :param features: features of the schedule if already built
+    :type features: ScheduleFeatures
+    :return: ranked movies
+    :rtype: list of tuple (movie, points)
+    """
+    if features is None:
+        features = ScheduleFeatures.from_schedule(schedule_movies)
+
+    return [(features.schedule_movies[i], points) for i, points in rank_movies(user, features)]
+
+
+def render_proposal(movie, movie_data_store):
+    """
+    Return the proposal of a movie of the schedule.
+    :param movie: movie of the schedule
+    :type movie: dict
+    :param movie_data_store: the movie in the datastore
+    :type movie_data_store: Movie
+    :return: proposal
+        {"channel": channel, "channelNumber": channel_number, "idIMDB": id_IMDB, "italianPlot": plot_it,
+        "originalTitle": original_title, "poster": poster, "runTimes": run_times, "simplePlot": simple_plot,
+        "time": time, "title": title}
+    :rtype: dict
+    """
+    return {"idIMDB": movie_data_store.key.id(),
+            "originalTitle": movie["originalTitle"] if movie["originalTitle"] is not None else movie["title"],
+            "poster": movie_data_store.poster,
+            "title": movie["title"] if movie["title"] is not None else movie["originalTitle"],
+            "channel": movie["channel"],
+            "channelNumber": movie.get("channelNumber", channel_number(movie["channel"])),
+            "time": movie["time"],
+            "runTimes": movie_data_store.run_times,
+            "simplePlot": movie_data_store.simple_plot,
+            "italianPlot": movie_data_store.plot_it}
+
+
+def build_proposal(user, features, limit=NUMBER_SUGGESTIONS, offset=0, scores=None):
+    """
+    Return a page of the proposal of the user from the schedule, only the movies of the page are read and rendered.
+    :param user: user
+    :type user: User
+    :param features: features of the schedule
+    :type features: ScheduleFeatures
+    :param limit: number of movies of the page
+    :type limit: int
+    :param offset: rank of the first movie of the page
+    :type offset: int
+    :param scores: points and hits of the movies if already computed
+    :type scores: tuple of numpy.ndarray
+    :return: proposal, ranked
+    :rtype: list of dict
+    """
+    rows = [i for i, points in rank_movies(user, features, offset + limit, scores)[offset:]]
+
+    proposals = []
+    for i, movie_data_store in zip(rows, features.get_movies(rows)):  # Read together the movies not read yet
+        movie = features.schedule_movies[i]
+        if movie_data_store is None:
+            logging.error("Non presente nel datastore: %s", features.movie_ids[i])
+            continue
+
+        logging.info("Scelto: %s", (str(movie["originalTitle"]) if movie["originalTitle"] is not None else str(
+            movie["title"])))
+        proposals.append(render_proposal(movie, movie_data_store))
+
+    return proposals
+
+
+def proposal_scores(user, features, proposal=None):
+    """
+    Return the scores of the movies of the schedule for the user. They are the ones stored with the proposal updated
+    with the changes of the tastes if the schedule is the same, otherwise they are computed again.
+    :param user: user
+    :type user: User
+    :param features: features of the schedule
+    :type features: ScheduleFeatures
+    :param proposal: stored proposal of the user for the day of the schedule, if any
+    :type proposal: Proposal
+    :return: points and hits of the movies
+    :rtype: tuple of numpy.ndarray
+    """
+    if proposal is not None and proposal.scores is not None and proposal.day == features.day and \
+            proposal.schedule_version == features.version:
+        changes = user.changes_since(proposal.taste_version)
+        if changes is not None:
+            points, hits = np.array(proposal.scores["points"]), np.array(proposal.scores["hits"])
+            return features.apply(points, hits, changes) if len(changes) > 0 else (points, hits)
+
+    return features.score(user.tastes)
+
+
+def update_proposal(user, features, proposal=None):
+    """
+    Compute the proposal of the user for the day of the schedule, it is not stored.
+    :param user: user
+    :type user: User
+    :param features: features of the schedule
+    :type features: ScheduleFeatures
+    :param proposal: stale proposal of the user for the day, if any
+    :type proposal: Proposal
+    :return: proposal
+    :rtype: Proposal
+    """
+    points, hits = proposal_scores(user, features, proposal)
+    movies = build_proposal(user, features, scores=(points, hits))
+
+    proposal = Proposal(key=Proposal.proposal_key(user.key.id(), features.day), day=features.day,
+                        schedule_version=features.version, taste_version=user.taste_version, movies=movies,
+                        scores={"points": points.tolist(), "hits": hits.tolist()})
+    return proposal
+
+
+def get_proposal(user, features):
+    """
+    Return the proposal of the user for the day of the schedule, it is computed only if the stored one is stale.
+    :param user: user
+    :type user: User
+    :param features: features of the schedule
+    :type features: ScheduleFeatures
+    :return: proposal
+    :rtype: Proposal
+    """
+    proposal = Proposal.proposal_key(user.key.id(), features.day).get()  # Cached in memcache by ndb
+    if proposal is not None and proposal.is_valid(features.day, features.version, user.taste_version):
+        return proposal
+
+    proposal = update_proposal(user, features, proposal)
+    proposal.put()
+    return proposal
+
+
+def compute_proposals(users, day="today"):
+    """
+    Compute and store the stale proposals of many users for a day together. The proposals and the tastes of the users
+    are read together and the features of the schedule are loaded once for every list of tv types.
+    :param users: users
+    :type users: list of User
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :return: number of proposals computed
+    :rtype: int
+    """
+    proposals = ndb.get_multi([Proposal.proposal_key(user.key.id(), schedule_date(day)) for user in users])
+
+    features = {}
+    stale = []
+    for user, proposal in zip(users, proposals):
+        tv_type_list = tuple(user.tv_type)
+        if tv_type_list not in features:
+            features[tv_type_list] = ScheduleFeatures.for_tv_types(list(tv_type_list), day)
+
+        features_user = features[tv_type_list]
+        if proposal is None or not proposal.is_valid(features_user.day, features_user.version, user.taste_version):
+            stale.append((user, proposal))
+
+    User.load_tastes([user for user, proposal in stale])
+    ndb.put_multi([update_proposal(user, features[tuple(user.tv_type)], proposal) for user, proposal in stale])
 
-    return data
+    return len(stale)
 
 if __name__ == "__main__":
     print taste_based_movie_selection(User.get_by_id("test@example.com"), result_movies_schedule("free", "today"))
\ No newline at end of file
@@ -5,17 +5,20 @@ from IMDB_retriever import retrieve_movie_from_title
 from google.appengine.api import taskqueue
 from datetime import datetime
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 from gcm import GCM
-from models import Artist, Movie, TasteArtist, TasteMovie, TasteGenre
+from models import Movie, Credit, TasteProfile, UserTastes, get_movies_artists, add_task, \
+    coalesce_writes
 from models import User
 from utilities import TV_TYPE, GENRES, ACTOR_WEIGHT, DIRECTOR_WEIGHT, WRITER_WEIGHT, GENRE_WEIGHT
 
-from movie_selector import random_movie_selection
+from movie_selector import ScheduleFeatures, CooccurrenceCounter, random_movie_selection, compute_proposals
 from send_mail import send_suggestion
-from tv_scheduling import result_movies_schedule
-from utilities import TV_TYPE, RetrieverError
+from tv_scheduling import result_movies_schedule, store_movies_schedule, stored_movies_schedule, \
+    scrape_movies_schedule, diff_movies_schedule
+from utilities import TV_TYPE, RetrieverError, PROPOSAL_BATCH_SIZE
 
-app = Flask(__name__)
+app = coalesce_writes(Flask(__name__))
 app.config['DEBUG'] = True
 
 
@@ -36,38 +39,40 @@ def retrieve(time):
 @app.route('/_ah/start/task/suggest')
 def suggest():
     """
+    Compute the proposals of all users for ?day= (today, tomorrow or future, default today).
     :return: simple confirmation string
     :rtype string
     """
-    taskqueue.add(url='/_ah/start/task/proposal', method='GET')
+    taskqueue.add(url='/_ah/start/task/proposal', params={'day': request.args.get('day', 'today')}, method='GET')
     return 'OK'
 
 
-@app.route('/_ah/start/task/clear')
-def clear():
-    """
-    :return: simple confirmation string
-    :rtype string
-    """
-    taskqueue.add(url='/_ah/start/task/proposal', method='DELETE')
-    return 'OK'
-
-
-@app.route('/_ah/start/task/proposal', methods=['GET', 'DELETE'])
+@app.route('/_ah/start/task/proposal', methods=['GET'])
 def proposal():
     """
+    Compute together the stale proposals of a page of users for ?day= (default today), the task enqueues itself with
+    the cursor of the next page.
     :return: simple confirmation string
     :rtype string
     """
     if request.method == 'GET':
-        users = User.query()
-        for user in users:
-            taskqueue.add(url='/api/proposal/' + user.key.id(), method='GET')
-    elif request.method == 'DELETE':
-        users = User.query()
-        for user in users:
-            user.proposal = None
-            user.put()
+        day = request.args.get('day', 'today')
+        cursor = request.args.get('cursor')
+        start_cursor = Cursor(urlsafe=cursor) if cursor is not None else None
+
+        users, next_cursor, more = User.query().order(User.key).fetch_page(PROPOSAL_BATCH_SIZE,
+                                                                             start_cursor=start_cursor)
+
+        try:
+            logging.info("Computed %d proposals of %s", compute_proposals(users, day), day)  # Only the stale ones
+        except Exception as exception:  # Fallback to a task for every user
+            logging.error("Error in computing the proposals of %d users: %s", len(users), exception)
+            for user in users:
+                add_task(url='/api/proposal/' + user.key.id(), method='GET', params={'day': day})
+
+        if more and next_cursor is not None:
+            taskqueue.add(url='/_ah/start/task/proposal', params={'cursor': next_cursor.urlsafe(), 'day': day},
+                          method='GET')
     else:
         raise MethodNotAllowed
     return 'OK'
@@ -83,37 +88,171 @@ def retrieve_type(tv_type, day):
 
     if tv_type in TV_TYPE:
         movies = result_movies_schedule(tv_type, day)  # Retrieve movies from today schedule
-        while len(movies) > 0:
-            movie_title = movies[0]['title']
-            movie_original_title = movies[0]['originalTitle']
-            movie_year = movies[0]['year']
-            movie_genre = movies[0]['genres']
-            movie_director = movies[0]['director']
-            movie_cast = movies[0]['cast']
-
-            if movie_original_title is None:
-                movie_original_title = movie_title
-
-            try:
-                retrieve_movie_from_title(movie_original_title,
-                                          movie_director,
-                                          movie_cast,
-                                          movie_title,
-                                          movies[0]['movieUrl'],
-                                          movie_year,
-                                          movie_genre)  # Retrieve movie from IMDB(or not) by title and year and store it
-                movies.pop(0)
-            except Exception as exception:
-                logging.error("Error in retrieving %s: %s", movie_original_title, exception)
-                if type(exception) is RetrieverError:
-                    logging.error("Not our error...")
-                movies.pop(0)
-                pass
+        for movie in movies:
+            if movie.get('idIMDB') is not None:  # Already retrieved, e.g. the night before as the day after tomorrow
+                continue
+
+            retrieve_schedule_movie(movie)
+
+        store_movies_schedule(tv_type, day, movies)  # Store the schedule with the id of the movies
+        ScheduleFeatures.build(tv_type, day, movies)  # Index the schedule for the scoring
         return 'OK'
     else:
         raise BadRequest
 
 
+def retrieve_schedule_movie(movie):
+    """
+    Retrieve a movie of the schedule from IMDB and remember its id in the movie with "idIMDB".
+    :param movie: movie of the schedule
+    :type movie: dict
+    :return: None
+    """
+    movie_title = movie['title']
+    movie_original_title = movie['originalTitle']
+    movie_year = movie['year']
+    movie_genre = movie['genres']
+    movie_director = movie['director']
+    movie_cast = movie['cast']
+
+    if movie_original_title is None:
+        movie_original_title = movie_title
+
+    try:
+        movie_key = retrieve_movie_from_title(movie_original_title,
+                                              movie_director,
+                                              movie_cast,
+                                              movie_title,
+                                              movie['movieUrl'],
+                                              movie_year,
+                                              movie_genre)  # Retrieve movie from IMDB(or not) by title and year and store it
+        movie['idIMDB'] = movie_key.id()  # Remember the movie found
+    except Exception as exception:
+        logging.error("Error in retrieving %s: %s", movie_original_title, exception)
+        if type(exception) is RetrieverError:
+            logging.error("Not our error...")
+
+
+@app.route('/_ah/start/task/refresh/<day>')
+def refresh(day):
+    """
+    Refresh the schedules of day of all tv types with the changes made by FilmTV after they were scraped.
+    :return: simple confirmation string
+    :rtype string
+    """
+    for tv_type in TV_TYPE:
+        taskqueue.add(url='/_ah/start/task/refresh/' + tv_type + '/' + day, method='GET')
+
+    return 'OK'
+
+
+@app.route('/_ah/start/task/refresh/<tv_type>/<day>', methods=['GET'])
+def refresh_type(tv_type, day):
+    """
+    Scrape again the schedule of day by tv type and compare it with the stored one by channel, time and title. Only the
+    movies added are retrieved from IMDB and, if something changed, the schedule is stored with a new version, so the
+    proposals computed with the previous one are found stale.
+    :return: simple confirmation string
+    :rtype string
+    """
+    if tv_type not in TV_TYPE:
+        raise BadRequest
+
+    stored = stored_movies_schedule(tv_type, day)
+    if stored is None:  # Never scraped, or lost: scraped as usual
+        return retrieve_type(tv_type, day)
+
+    movies, changed, removed = diff_movies_schedule(stored, scrape_movies_schedule(tv_type, day))
+    if len(changed) == 0 and removed == 0:
+        logging.info("Schedule %s of %s not changed", tv_type, day)
+        return 'OK'
+
+    logging.info("Schedule %s of %s changed: %d movies added or changed, %d removed", tv_type, day,
+                 len(changed), removed)
+    for movie in changed:
+        if movie.get('idIMDB') is None:  # Not only moved to another time or channel
+            retrieve_schedule_movie(movie)
+
+    store_movies_schedule(tv_type, day, movies)
+    ScheduleFeatures.build(tv_type, day, movies)  # New version of the schedule
+    return 'OK'
+
+
+@app.route('/_ah/start/task/index/filmography', methods=['GET'])
+def index_filmography():
+    """
+    Build the filmography index of the artists from the credits of the movies already in the datastore, a page of
+    movies at time. The task enqueues itself with the cursor of the next page.
+    :return: simple confirmation string
+    :rtype string
+    """
+    cursor = request.args.get('cursor')
+    start_cursor = Cursor(urlsafe=cursor) if cursor is not None else None
+
+    movies, next_cursor, more = Movie.query().fetch_page(100, start_cursor=start_cursor)
+
+    credits_list = []
+    for movie in movies:
+        credits_list.extend(Credit.index_movie(movie))
+    ndb.put_multi(credits_list)
+
+    if more and next_cursor is not None:
+        taskqueue.add(url='/_ah/start/task/index/filmography', params={'cursor': next_cursor.urlsafe()},
+                      method='GET')
+
+    return 'OK'
+
+
+@app.route('/_ah/start/task/migrate/tastes', methods=['GET'])
+def migrate_tastes():
+    """
+    Move the tastes of the users from TasteMovie, TasteArtist and TasteGenre entities to their TasteProfile, a page of
+    users at time. The task enqueues itself with the cursor of the next page.
+    :return: simple confirmation string
+    :rtype string
+    """
+    cursor = request.args.get('cursor')
+    start_cursor = Cursor(urlsafe=cursor) if cursor is not None else None
+
+    users, next_cursor, more = User.query().fetch_page(50, start_cursor=start_cursor)
+
+    profiles = ndb.get_multi([TasteProfile.shard_key(user.key.id(), 0) for user in users])
+    for user, profile in zip(users, profiles):
+        if profile is None:  # Not migrated yet
+            UserTastes.migrate(user)
+
+    if more and next_cursor is not None:
+        taskqueue.add(url='/_ah/start/task/migrate/tastes', params={'cursor': next_cursor.urlsafe()}, method='GET')
+
+    return 'OK'
+
+
+@app.route('/_ah/start/task/neighbours', methods=['GET'])
+def neighbours():
+    """
+    Build the neighbours of the artists and of the movies from the tastes of all users. The users are read a page at
+    time in the same request, this module has not the deadline of the automatic scaling ones.
+    :return: simple confirmation string
+    :rtype string
+    """
+    counter = CooccurrenceCounter()
+
+    cursor = None
+    more = True
+    while more:
+        users, cursor, more = User.query().fetch_page(500, start_cursor=cursor)
+        for user_tastes in UserTastes.load_multi(users):
+            counter.add(user_tastes)
+        ndb.get_context().clear_cache()  # Do not keep all users in memory
+        more = more and cursor is not None
+
+    items_neighbours = counter.neighbours()
+    ndb.put_multi(items_neighbours)
+    logging.info("Stored the neighbours of %d items", len(items_neighbours))
+
+    return 'OK'
+
+
 @app.route('/_ah/start/task/manual/<offset>')
 def manual(offset):
     """
@@ -168,24 +307,25 @@ def add_movie_tastes(user_id, movie_id, taste):
         taste = float(taste)
         user = User.get_by_id(user_id)
         movie = Movie.get_by_id(movie_id)
+        artists = get_movies_artists([movie])  # Get all artists of the movie together
+
         for actor in movie.actors:
-            artist = Artist.get_by_id(actor.id())
-            user.add_taste_artist(artist, ACTOR_WEIGHT * taste)
+            if actor in artists:
+                user.add_taste_artist(artists[actor], ACTOR_WEIGHT * taste)
 
         for director in movie.directors:
-            artist = Artist.get_by_id(director.id())
-            user.add_taste_artist(artist, DIRECTOR_WEIGHT * taste)
+            if director in artists:
+                user.add_taste_artist(artists[director], DIRECTOR_WEIGHT * taste)
 
         for writer in movie.writers:
-            artist = Artist.get_by_id(writer.id())
-            user.add_taste_artist(artist, WRITER_WEIGHT * taste)
+            if writer in artists:
+                user.add_taste_artist(artists[writer], WRITER_WEIGHT * taste)
 
         for genre in movie.genres:
             user.add_taste_genre(genre, GENRE_WEIGHT * taste)
 
-        user.remove_proposal()
         user.put()
-        taskqueue.add(url='/api/proposal/' + user.key.id(), method='GET')
+        add_task(url='/api/proposal/' + user.key.id(), method='GET')  # Apply the changes to the proposal
 
 
         return 'OK'
@@ -194,56 +334,30 @@ def add_movie_tastes(user_id, movie_id, taste):
 def untaste_movie(user_id, movie_id):
             movie = Movie.get_by_id(movie_id)
             user = User.get_by_id(user_id)
+            artists = get_movies_artists([movie])  # Get all artists of the movie together
 
-            for actor in movie.actors:
-                artist = Artist.get_by_id(actor.id())
-                taste_artist = TasteArtist.get_by_id(actor.id() + user.key.id())
-
-                if taste_artist is not None:
-                    taste_artist.update_taste(-ACTOR_WEIGHT)
-                else:
-                    user.add_taste_artist(artist, -ACTOR_WEIGHT)
-
-                if taste_artist.taste == 0:
-                    user.remove_taste_artist(artist)
-
-            for director in movie.directors:
-                artist = Artist.get_by_id(director.id())
-                taste_artist = TasteArtist.get_by_id(director.id() + user.key.id())
+            for artist_keys, weight in ((movie.actors, ACTOR_WEIGHT),
+                                        (movie.directors, DIRECTOR_WEIGHT),
+                                        (movie.writers, WRITER_WEIGHT)):
+                for artist_key in artist_keys:
+                    if artist_key not in artists:
+                        continue
+                    artist = artists[artist_key]
 
-                if taste_artist is not None:
-                    taste_artist.update_taste(-DIRECTOR_WEIGHT)
-                else:
-                    user.add_taste_artist(artist, -DIRECTOR_WEIGHT)
+                    user.add_taste_artist(artist, -weight)  # Update the taste or create a negative one
 
-                if taste_artist.taste == 0:
-                    user.remove_taste_artist(artist)
-
-            for writer in movie.writers:
-                artist = Artist.get_by_id(writer.id())
-                taste_artist = TasteArtist.get_by_id(writer.id() + user.key.id())
-
-                if taste_artist is not None:
-                    taste_artist.update_taste(-WRITER_WEIGHT)
-                else:
-                    user.add_taste_artist(artist, -WRITER_WEIGHT)
-
-                if taste_artist.taste == 0:
-                    user.remove_taste_artist(artist)
+                    taste_artist = user.tastes.get("artist", artist_key.id())
+                    if taste_artist is not None and taste_artist.taste == 0:
+                        user.remove_taste_artist(artist)
 
             for genre in movie.genres:
-                taste_genre = TasteGenre.get_by_id(genre + user.key.id())
-
-                if taste_genre is not None:
-                    taste_genre.update_taste(-GENRE_WEIGHT)
-                else:
-                    user.add_taste_genre(genre, -GENRE_WEIGHT)
+                user.add_taste_genre(genre, -GENRE_WEIGHT)  # Update the taste or create a negative one
 
-                if taste_genre.taste == 0:
+                taste_genre = user.tastes.get("genre", genre)
+                if taste_genre is not None and taste_genre.taste == 0:
                     user.remove_taste_genre(genre)
 
-            user.remove_proposal()
             user.put()
-            taskqueue.add(url='/api/proposal/' + user.key.id(), method='GET')
+            add_task(url='/api/proposal/' + user.key.id(), method='GET')  # Apply the changes to the proposal
 
             return 'OK'
@@ -1,52 +1,252 @@
+import heapq
 import logging
+import threading
+from bisect import bisect_left, bisect_right
+import time as clock
+from collections import OrderedDict
+from datetime import date, timedelta
 from google.appengine.api import memcache
+from google.appengine.ext import ndb
 import lxml.html
+from lxml import etree
 from werkzeug.exceptions import BadRequest, InternalServerError
-from utilities import TV_TYPE, BASE_URL_FILMTV_FILM, time_for_tomorrow, get
+from utilities import TV_TYPE, BASE_URL_FILMTV_FILM, SCHEDULE_FIELDS, SCHEDULE_TABLES, time_for_tomorrow, get_parsed, \
+    concurrent_map, channel_number, encode_records, decode_records, CHANNEL_NOT_FOUND
+from models import ScheduleDay
+
+
+FILM_LINK = 'contains(@href, "http://www.filmtv.it/film/")'
+MOVIES_XPATH = etree.XPath('//article[@class="item item-scheda item-scheda-film cf option-view-list"]')
+TITLE_XPATH = etree.XPath('.//a[' + FILM_LINK + ']/text()', smart_strings=False)
+MOVIE_URL_XPATH = etree.XPath('.//a[' + FILM_LINK + ']/@href', smart_strings=False)
+ORIGINAL_TITLE_XPATH = etree.XPath('.//p[@class="titolo-originale"]/text()', smart_strings=False)
+YEAR_XPATH = etree.XPath('.//ul[@class="info cf"]/li/time/text()', smart_strings=False)
+CHANNEL_XPATH = etree.XPath('.//h3[@class="media tv"]/text()', smart_strings=False)
+TIME_XPATH = etree.XPath('.//time[@class="data"]/text()', smart_strings=False)
+DIRECTOR_XPATH = etree.XPath('.//p[@class="regia"]/text()', smart_strings=False)
+GENRE_XPATH = etree.XPath('.//ul[@class="info cf"]/li/text()', smart_strings=False)
+CAST_XPATH = etree.XPath('.//p[@class="cast"]/text()', smart_strings=False)
+
+
+EVENING_START_HOUR = 6  # The movies before this hour are the last ones of the evening before
+UNKNOWN_MINUTES = 48 * 60  # After every movie with a time
+
+
+def schedule_minutes(time):
+    """
+    Return the minutes since the midnight of the day of the schedule, the movies after midnight are of the evening
+    before so they are after the last minute of the day.
+    :param time: time as HH:MM
+    :type time: string
+    :return: minutes or None if not a time
+    :rtype: int
+    """
+    try:
+        hours, minutes = [int(value) for value in time.split(":")]
+    except (AttributeError, ValueError):
+        return None
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        return None
+
+    return (hours + (24 if hours < EVENING_START_HOUR else 0)) * 60 + minutes
+
+
+def movie_minutes(movie):
+    """
+    Return the minutes of a movie of the schedule, to sort and search it.
+    :param movie: movie of the schedule
+    :type movie: dict
+    :return: minutes, UNKNOWN_MINUTES if not known
+    :rtype: int
+    """
+    minutes = movie["minutes"] if "minutes" in movie else schedule_minutes(movie["time"])  # Parsed before minutes
+    return minutes if minutes is not None else UNKNOWN_MINUTES
 
 
 def get_movies_schedule(html_page):
     """
     Parse HTML page and retrieve information about movies schedule as title, original title, channel and time of
-    transmission.
+    transmission. The XPath expressions are compiled once and every one is evaluated once for a movie.
+    The movies are sorted by time, see schedule_minutes.
     :param html_page: HTML page to parse
     :type html_page: string
     :return: list JSON object of movie scraped
-        {"title": title, "originalTitle": original_title, "channel": channel, "time": time}
+        {"title": title, "originalTitle": original_title, "channel": channel, "channelNumber": channel_number,
+        "time": time, "minutes": minutes}
     :rtype: list of dict
     """
     movies_list = []
+    seen = set()
     tree = lxml.html.fromstring(html_page)
 
-    movies_node = tree.xpath('//article[@class="item item-scheda item-scheda-film cf option-view-list"]')  # Get movies
-    for movie_node in movies_node:
-        title = movie_node.xpath('.//a[contains(@href, "http://www.filmtv.it/film/")]/text()')[0].strip().encode(
-            'utf-8')  # Get title
-        movie_url = movie_node.xpath('.//a[contains(@href, "http://www.filmtv.it/film/")]/@href')[0]  # Get FilmTV url
-        original_title = movie_node.xpath('.//p[@class="titolo-originale"]/text()')  # Get original title
-        year = movie_node.xpath('.//ul[@class="info cf"]/li/time/text()')[0]  # Get year
-        if len(original_title) == 0:
-            original_title = None
-        else:
-            original_title = original_title[0].strip().encode('utf-8')
-        channel = movie_node.xpath('.//h3[@class="media tv"]/text()')[0].strip().encode('utf-8')  # Get channel
-        time = movie_node.xpath('.//time[@class="data"]/text()')[0][2:].strip()  # Get time
-        director = movie_node.xpath('.//p[@class="regia"]/text()')[0].strip().encode('utf-8')   # Get director
-        genre = movie_node.xpath('.//ul[@class="info cf"]/li/text()')[0].encode('utf-8')  # Get genre
-        cast = movie_node.xpath('.//p[@class="cast"]/text()')
-        if len(cast) == 0:
-            cast = None
-        else:
-            cast = movie_node.xpath('.//p[@class="cast"]/text()')[0].strip().encode('utf-8')  # Get cast
-        if channel != "Rsi La1" and channel != "Rsi La2":  # Remove the swiss channels
-            value = {"title": title, "originalTitle": original_title, "channel": channel, "time": time,
-                     "movieUrl": movie_url, "year": year, "director": director, "genres": genre, "cast": cast}
-            movies_list.append(value) if value not in movies_list else logging.info("Movie already in schedule")
-            # Control of doubles in schedule
+    for movie_node in MOVIES_XPATH(tree):  # Get movies
+        channel = CHANNEL_XPATH(movie_node)[0].strip().encode('utf-8')  # Get channel
+        if channel == "Rsi La1" or channel == "Rsi La2":  # Remove the swiss channels
+            continue
+
+        title = TITLE_XPATH(movie_node)[0].strip().encode('utf-8')  # Get title
+        movie_url = MOVIE_URL_XPATH(movie_node)[0]  # Get FilmTV url
+        original_title = ORIGINAL_TITLE_XPATH(movie_node)  # Get original title
+        original_title = original_title[0].strip().encode('utf-8') if len(original_title) > 0 else None
+        year = YEAR_XPATH(movie_node)[0]  # Get year
+        time = TIME_XPATH(movie_node)[0][2:].strip()  # Get time
+        director = DIRECTOR_XPATH(movie_node)[0].strip().encode('utf-8')  # Get director
+        genre = GENRE_XPATH(movie_node)[0].encode('utf-8')  # Get genre
+        cast = CAST_XPATH(movie_node)  # Get cast
+        cast = cast[0].strip().encode('utf-8') if len(cast) > 0 else None
+
+        value = {"title": title, "originalTitle": original_title, "channel": channel, "time": time,
+                 "movieUrl": movie_url, "year": year, "director": director, "genres": genre, "cast": cast,
+                 "minutes": schedule_minutes(time), "channelNumber": channel_number(channel)}
+        key = (title, original_title, channel, time, movie_url, year, director, genre, cast)
+        if key in seen:  # Control of doubles in schedule
+            logging.info("Movie already in schedule")
+            continue
 
+        seen.add(key)
+        movies_list.append(value)
+
+    movies_list.sort(key=movie_minutes)  # Stable, the movies at the same time keep the order of the page
     return movies_list
 
 
+DAYS = {"TODAY": ("oggi", 0), "TOMORROW": ("domani", 1), "FUTURE": ("dopodomani", 2)}
+
+
+def schedule_date(day):
+    """
+    Return the date of a day of the schedule.
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :return: date of the day
+    :rtype: date
+    """
+    if day.upper() not in DAYS:
+        raise BadRequest
+
+    return date.today() + timedelta(days=DAYS[day.upper()][1])
+
+
+def schedule_cache_key(tv_type, day):
+    """
+    Return the memcache key of a schedule. It uses the date of the day, so the schedule of tomorrow is found as the
+    schedule of today the day after.
+    :param tv_type: type of TV, possible value (free, sky, premium)
+    :type tv_type: string
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :return: memcache key
+    :rtype: string
+    """
+    return tv_type.lower() + schedule_date(day).isoformat()
+
+
+SCHEDULE_CACHE_SIZE = 9  # The three days of the three tv types
+SCHEDULE_CACHE_TTL = 600  # Seconds a schedule is kept in the instance, another instance could change it
+SCHEDULE_LEASE_TIME = 60  # Seconds an instance can scrape a schedule before another one tries
+SCHEDULE_LEASE_POLL = 0.5
+
+_schedule_cache = OrderedDict()  # Least recently used first, cache key -> (expiration, schedule, minutes)
+_schedule_cache_lock = threading.Lock()
+
+
+def cached_schedules(cache_keys):
+    """
+    Get the schedules kept in the instance.
+    :param cache_keys: memcache keys of the schedules
+    :type cache_keys: list of string
+    :return: schedules found, by cache key
+    :rtype: dict
+    """
+    now = clock.time()
+    found = {}
+    with _schedule_cache_lock:
+        for cache_key in cache_keys:
+            entry = _schedule_cache.get(cache_key)
+            if entry is not None and entry[0] > now:
+                del _schedule_cache[cache_key]
+                _schedule_cache[cache_key] = entry  # Most recently used
+                found[cache_key] = entry[1]
+
+    return found
+
+
+def stale_schedule(cache_key):
+    """
+    Get the schedule kept in the instance even if expired, the previous version is better than nothing.
+    :param cache_key: memcache key of the schedule
+    :type cache_key: string
+    :return: schedule or None if not kept
+    :rtype: list of dict
+    """
+    with _schedule_cache_lock:
+        entry = _schedule_cache.get(cache_key)
+
+    return entry[1] if entry is not None else None
+
+
+def cached_minutes(cache_key, schedule):
+    """
+    Get the sorted minutes of the movies of a schedule kept in the instance, see cache_schedules.
+    :param cache_key: memcache key of the schedule
+    :type cache_key: string
+    :param schedule: schedule
+    :type schedule: list of dict
+    :return: minutes of every movie, None if the schedule is not kept or it is not sorted
+    :rtype: list of int
+    """
+    with _schedule_cache_lock:
+        entry = _schedule_cache.get(cache_key)
+
+    return entry[2] if entry is not None and entry[1] is schedule else None
+
+
+def cache_schedules(schedules):
+    """
+    Keep the schedules in the instance, the least recently used ones are dropped. The minutes of their movies are kept
+    with them, so the schedules can be searched by time without reading all the movies.
+    :param schedules: schedules, by cache key
+    :type schedules: dict
+    :return: None
+    """
+    expiration = clock.time() + SCHEDULE_CACHE_TTL
+    entries = {}
+    for cache_key, schedule in schedules.items():
+        minutes = [movie_minutes(movie) for movie in schedule]
+        if any(minutes[i] > minutes[i + 1] for i in range(len(minutes) - 1)):  # Parsed before it was sorted
+            minutes = None
+        entries[cache_key] = (expiration, schedule, minutes)
+
+    with _schedule_cache_lock:
+        for cache_key, entry in entries.items():
+            _schedule_cache.pop(cache_key, None)
+            _schedule_cache[cache_key] = entry
+        while len(_schedule_cache) > SCHEDULE_CACHE_SIZE:
+            _schedule_cache.popitem(last=False)
+
+
+def encode_schedule(schedule):
+    """
+    Encode a schedule for memcache, see utilities.encode_records. It is read with decode_records.
+    :param schedule: schedule
+    :type schedule: list of dict
+    :return: encoded schedule
+    :rtype: string
+    """
+    return encode_records(schedule, SCHEDULE_FIELDS, SCHEDULE_TABLES)
+
+
+def schedule_expiration(day):
+    """
+    Return the seconds a schedule is kept in memcache, until the end of its day.
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :return: seconds
+    :rtype: float
+    """
+    return time_for_tomorrow() + DAYS[day.upper()][1] * 86400
+
+
 def result_movies_schedule(tv_type, day):
     """
     Get TV movies schedule from www.filmtv.it. You could ask the schedule of today, tomorrow and the day after tomorrow
@@ -59,43 +259,394 @@ def result_movies_schedule(tv_type, day):
         {"title": title, "originalTitle": original_title, "channel": channel, "time": time}
     :rtype: list of dict
     """
-    if day.upper() == "TODAY":  # Translate day for get call
-        day = "oggi"
-    elif day.upper() == "TOMORROW":
-        day = "domani"
-    elif day.upper() == "FUTURE":
-        day = "dopodomani"
-    else:
+    return result_movies_schedules([tv_type], day)[0]
+
+
+def schedule_url(tv_type, day):
+    """
+    Return the URL of the FilmTV page of a schedule.
+    :param tv_type: type of TV from get schedule, possible value (free, sky, premium)
+    :type tv_type: string
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :return: URL
+    :rtype: string
+    :raise BadRequest: if the tv type or the day are not valid
+    """
+    if day.upper() not in DAYS:
         raise BadRequest
 
+    day = DAYS[day.upper()][0]  # Translate day for get call
     tv_type = tv_type.lower()
 
-    schedule = memcache.get(tv_type + day)  # Tries to retrieve the schedule from memcache
-    if schedule is not None:  # Control if it was retrieved
-        return schedule
-    else:  # Else retrieve it
-        if tv_type == TV_TYPE[0]:
-            url = BASE_URL_FILMTV_FILM + day + "/stasera/"
-        elif tv_type == TV_TYPE[1] or tv_type == TV_TYPE[2]:
-            url = BASE_URL_FILMTV_FILM + day + "/stasera/" + tv_type
+    if tv_type == TV_TYPE[0]:
+        return BASE_URL_FILMTV_FILM + day + "/stasera/"
+    elif tv_type == TV_TYPE[1] or tv_type == TV_TYPE[2]:
+        return BASE_URL_FILMTV_FILM + day + "/stasera/" + tv_type
+    else:
+        raise BadRequest
+
+
+def scrape_movies_schedule(tv_type, day):
+    """
+    Get TV movies schedule from www.filmtv.it as it is now, without storing it. The page is parsed only if changed.
+    :param tv_type: type of TV from get schedule, possible value (free, sky, premium)
+    :type tv_type: string
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :return: list JSON object of movie info scraped
+    :rtype: list of dict
+    """
+    return get_parsed(schedule_url(tv_type, day), get_movies_schedule, encode_schedule, decode_records)
+
+
+def stored_movies_schedule(tv_type, day):
+    """
+    Get the schedule stored in the datastore, the version the other ones are copies of.
+    :param tv_type: type of TV, possible value (free, sky, premium)
+    :type tv_type: string
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :return: schedule or None if not stored
+    :rtype: list of dict
+    """
+    stored = ScheduleDay.schedule_key(tv_type, schedule_date(day)).get()
+
+    return stored.movies if stored is not None and stored.day == schedule_date(day) else None
+
+
+def schedule_entry_key(movie):
+    """
+    Return what identifies a movie in a schedule, to compare two versions of it.
+    :param movie: movie of the schedule
+    :type movie: dict
+    :return: channel, time and title
+    :rtype: tuple
+    """
+    return movie["channel"], movie["time"], movie["title"]
+
+
+def diff_movies_schedule(old_schedule, new_schedule):
+    """
+    Compare two versions of a schedule by channel, time and title. The movies of the new version found in the old one,
+    or moved to another time or channel (same FilmTV url), keep the id of the movie retrieved with "idIMDB".
+    :param old_schedule: previous version of the schedule
+    :type old_schedule: list of dict
+    :param new_schedule: new version of the schedule
+    :type new_schedule: list of dict
+    :return: the new version, its movies added or changed and the number of movies of the old one removed or changed
+    :rtype: tuple (list of dict, list of dict, int)
+    """
+    old_movies = dict((schedule_entry_key(movie), movie) for movie in old_schedule)
+    new_keys = set(schedule_entry_key(movie) for movie in new_schedule)
+    old_ids = dict((movie["movieUrl"], movie["idIMDB"]) for key, movie in old_movies.items()
+                   if key not in new_keys and movie.get("idIMDB") is not None)  # Of the movies removed or changed
+
+    schedule = []
+    changed = []
+    for movie in new_schedule:
+        old_movie = old_movies.get(schedule_entry_key(movie))
+        movie = dict(movie)
+        if old_movie is not None:
+            if old_movie.get("idIMDB") is not None:
+                movie["idIMDB"] = old_movie["idIMDB"]
         else:
-            raise BadRequest
+            if movie["movieUrl"] in old_ids:
+                movie["idIMDB"] = old_ids[movie["movieUrl"]]
+            changed.append(movie)
+        schedule.append(movie)
 
-        html_page = get(url)  # Get HTML page
-        schedule = get_movies_schedule(html_page)  # Retrieve schedule
+    return schedule, changed, len([key for key in old_movies if key not in new_keys])
+
+
+def fetch_movies_schedule(tv_type, day):
+    """
+    Get TV movies schedule from www.filmtv.it, without looking for it, and store it in memcache and in the datastore.
+    :param tv_type: type of TV from get schedule, possible value (free, sky, premium)
+    :type tv_type: string
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :return: list JSON object of movie info scraped
+    :rtype: list of dict
+    """
+    cache_key = schedule_cache_key(tv_type, day)
+    schedule = scrape_movies_schedule(tv_type, day)  # Get HTML page and retrieve schedule, if changed
 
+    if schedule is not None:
+        memcache.add(cache_key, encode_schedule(schedule), schedule_expiration(day))  # Store it in memcache
+        ScheduleDay(key=ScheduleDay.schedule_key(tv_type, schedule_date(day)), day=schedule_date(day),
+                    movies=schedule).put()  # And in the datastore, for when memcache evicts it
+        return schedule
+    else:
+        raise InternalServerError('TV scheduling not retrieved')
+
+
+class ScheduleFetch(object):
+    """
+    A scrape of a schedule in progress in the instance, the other threads that need the schedule wait for it.
+    """
+
+    def __init__(self):
+        """
+        Constructor of ScheduleFetch.
+        :return: None
+        """
+        self.done = threading.Event()
+        self.schedule = None
+        self.error = None
+
+
+_schedule_fetches = {}  # cache key -> ScheduleFetch in progress
+_schedule_fetches_lock = threading.Lock()
+
+
+def single_flight_schedule(tv_type, day):
+    """
+    Get a schedule missing from memcache and from the datastore, scraping it once whatever the concurrency. In the
+    instance the threads wait for the one scraping it, among the instances only the one that takes the lease in
+    memcache scrapes it, see leased_fetch_schedule.
+    :param tv_type: type of TV from get schedule, possible value (free, sky, premium)
+    :type tv_type: string
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :return: list JSON object of movie info scraped
+    :rtype: list of dict
+    """
+    cache_key = schedule_cache_key(tv_type, day)
+    with _schedule_fetches_lock:
+        fetch = _schedule_fetches.get(cache_key)
+        leader = fetch is None
+        if leader:
+            fetch = _schedule_fetches[cache_key] = ScheduleFetch()
+
+    if not leader:
+        fetch.done.wait(SCHEDULE_LEASE_TIME)
+        if fetch.schedule is not None:
+            return fetch.schedule
+        raise fetch.error if fetch.error is not None else InternalServerError('TV scheduling not retrieved')
+
+    try:
+        fetch.schedule = leased_fetch_schedule(tv_type, day)
+        return fetch.schedule
+    except Exception as exception:
+        fetch.error = exception
+        raise
+    finally:
+        with _schedule_fetches_lock:
+            del _schedule_fetches[cache_key]
+        fetch.done.set()
+
+
+def leased_fetch_schedule(tv_type, day):
+    """
+    Scrape a schedule if this instance takes the lease in memcache. Otherwise another instance is scraping it: the
+    previous version kept in the instance is returned if any, else it waits for the schedule in memcache while the lease
+    is held. If the lease is released or expires without the schedule, it tries to take the lease and scrape the schedule
+    itself. If memcache is not available, the schedule is scraped without the lease.
+    :param tv_type: type of TV from get schedule, possible value (free, sky, premium)
+    :type tv_type: string
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :return: list JSON object of movie info scraped
+    :rtype: list of dict
+    :raise InternalServerError: if the lease holders do not scrape the schedule in SCHEDULE_LEASE_TIME
+    """
+    cache_key = schedule_cache_key(tv_type, day)
+    lease_key = "lease:" + cache_key
+
+    def scrape():
+        if not memcache.add(lease_key, True, SCHEDULE_LEASE_TIME):
+            if memcache.get(lease_key) is None:  # Memcache not available
+                logging.warning("Lease of schedule %s not available, scraping it", cache_key)
+                return fetch_movies_schedule(tv_type, day)
+            return None  # Held by another instance
+
+        try:
+            schedule = decode_records(memcache.get(cache_key))  # Stored while taking the lease
+            return schedule if schedule is not None else fetch_movies_schedule(tv_type, day)
+        finally:
+            memcache.delete(lease_key)
+
+    schedule = scrape()
+    if schedule is not None:
+        return schedule
+
+    schedule = stale_schedule(cache_key)
+    if schedule is not None:
+        logging.info("Schedule %s is being scraped, the previous version is used", cache_key)
+        return schedule
+
+    deadline = clock.time() + SCHEDULE_LEASE_TIME
+    while clock.time() < deadline:
+        clock.sleep(SCHEDULE_LEASE_POLL)
+        schedule = decode_records(memcache.get(cache_key))
+        if schedule is None and memcache.get(lease_key) is None:  # Released or expired without the schedule
+            logging.warning("Schedule %s not scraped by the lease holder, taking the lease", cache_key)
+            schedule = scrape()
         if schedule is not None:
-            memcache.add(tv_type + day, schedule, time_for_tomorrow())  # Store the schedule in memcache
             return schedule
-        else:
-            raise InternalServerError('TV scheduling not retrieved')
 
+    logging.error("Schedule %s not scraped by the lease holder in time", cache_key)
+    raise InternalServerError('TV scheduling not retrieved')
 
-def result_movies_schedule_list(tv_type_list):
+
+def result_movies_schedules(tv_type_list, day):
     """
-    This combine all the movies in schedule for the different tv types present in the list
+    Get the schedules of many tv types. They are looked for in the instance, then in memcache and then in the datastore,
+    every tier read once for all of them. The missing ones are retrieved from www.filmtv.it concurrently, so it takes
+    the time of the slowest one, and once whatever the number of callers.
+    :param tv_type_list: list of tv types
+    :type tv_type_list: list of string
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :return: schedule of every tv type, in the order of the list
+    :rtype: list of list of dict
+    """
+    cache_keys = [schedule_cache_key(tv_type, day) for tv_type in tv_type_list]
+    found = cached_schedules(cache_keys)
+
+    missing = [cache_key for cache_key in cache_keys if cache_key not in found]
+    if len(missing) > 0:
+        found_memcache = memcache.get_multi(missing)
+        found.update((cache_key, decode_records(value)) for cache_key, value in found_memcache.items())
+
+        missing = []
+        for tv_type, cache_key in zip(tv_type_list, cache_keys):
+            if cache_key not in found and tv_type not in missing:
+                missing.append(tv_type)
 
+        found_datastore = {}
+        if len(missing) > 0:
+            schedule_day = schedule_date(day)
+            stored = ndb.get_multi([ScheduleDay.schedule_key(tv_type, schedule_day) for tv_type in missing])
+            for tv_type, schedule in zip(missing, stored):
+                if schedule is not None and schedule.day == schedule_day:
+                    found_datastore[schedule_cache_key(tv_type, day)] = schedule.movies
+            if len(found_datastore) > 0:
+                memcache.set_multi(dict((cache_key, encode_schedule(schedule)) for cache_key, schedule in
+                                        found_datastore.items()), schedule_expiration(day))  # Back in memcache
+                found.update(found_datastore)
+
+        missing = [tv_type for tv_type in missing if schedule_cache_key(tv_type, day) not in found]
+        for tv_type, schedule in zip(missing, concurrent_map(lambda tv_type: single_flight_schedule(tv_type, day),
+                                                             missing)):
+            found[schedule_cache_key(tv_type, day)] = schedule
+
+        cache_schedules(dict((cache_key, found[cache_key]) for cache_key in cache_keys))
+
+    return [found[cache_key] for cache_key in cache_keys]
+
+
+def store_movies_schedule(tv_type, day, schedule):
+    """
+    Replace the stored schedule, e.g. after adding the id of the movies retrieved with "idIMDB".
+    :param tv_type: type of TV, possible value (free, sky, premium)
+    :type tv_type: string
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :param schedule: schedule to store
+    :type schedule: list of dict
+    :return: None
+    """
+    cache_key = schedule_cache_key(tv_type, day)
+    memcache.set(cache_key, encode_schedule(schedule), schedule_expiration(day))
+    ScheduleDay(key=ScheduleDay.schedule_key(tv_type, schedule_date(day)), day=schedule_date(day), movies=schedule).put()
+    cache_schedules({cache_key: schedule})
+
+
+def result_schedule_indexes(tv_type_list, day):
+    """
+    Get together the indexes of the features of the schedules of many tv types.
     :param tv_type_list: list of tv types
+    :type tv_type_list: list of string
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :return: index of every tv type or None if not built, in the order of the list
+    :rtype: list of dict
+    """
+    cache_keys = ["index:" + schedule_cache_key(tv_type, day) for tv_type in tv_type_list]
+    indexes = memcache.get_multi(cache_keys)
+
+    return [indexes.get(cache_key) for cache_key in cache_keys]
+
+
+def store_schedule_index(tv_type, day, index):
+    """
+    Store the index of the features of a schedule, it expires together with the schedule.
+    :param tv_type: type of TV, possible value (free, sky, premium)
+    :type tv_type: string
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :param index: index to store
+    :type index: dict
+    :return: None
+    """
+    memcache.set("index:" + schedule_cache_key(tv_type, day), index, schedule_expiration(day))
+
+
+def on_channel(movie, channel):
+    """
+    Check if a movie of the schedule is on a channel, the channels without a number are found only by name.
+    :param movie: movie of the schedule
+    :type movie: dict
+    :param channel: number or name of the channel
+    :type channel: string
+    :return: True if the movie is on the channel
+    :rtype: bool
+    """
+    number = movie.get("channelNumber")
+    return channel == movie["channel"] or (number != CHANNEL_NOT_FOUND and channel == number)
+
+
+def query_movies_schedule(tv_type_list, day, start=None, end=None, channel=None):
+    """
+    Return the movies of the schedules of many tv types in a time window and on a channel, merged by time. The window
+    is found with a binary search in the minutes of every schedule, kept with it in the instance.
+    :param tv_type_list: list of tv types
+    :type tv_type_list: list of string
+    :param day: interested day, possible value (today, tomorrow, future)
+    :type day: string
+    :param start: first minute of the window, see schedule_minutes, None from the first movie
+    :type start: int
+    :param end: last minute of the window, None to the last movie
+    :type end: int
+    :param channel: number or name of the channel, None for all of them
+    :type channel: string
+    :return: movies, with the tv type as "type"
+    :rtype: list of dict
+    """
+    schedules = []
+    slices = []
+    for tv_type, schedule in zip(tv_type_list, result_movies_schedules(tv_type_list, day)):
+        minutes = cached_minutes(schedule_cache_key(tv_type, day), schedule)
+        if minutes is None:
+            minutes = [movie_minutes(movie) for movie in schedule]
+            if any(minutes[i] > minutes[i + 1] for i in range(len(minutes) - 1)):  # Parsed before it was sorted
+                schedule = sorted(schedule, key=movie_minutes)
+                minutes.sort()
+
+        first = bisect_left(minutes, start) if start is not None else 0
+        last = bisect_right(minutes, end) if end is not None else len(minutes)
+        schedules.append(schedule)
+        slices.append([(minutes[i], len(slices), i) for i in range(first, last)
+                       if channel is None or on_channel(schedule[i], channel)])
+
+    movies = []
+    for minutes, k, i in heapq.merge(*slices):  # By time, then by tv type
+        movie = dict(schedules[k][i])
+        movie["type"] = tv_type_list[k]
+        movies.append(movie)
+
+    return movies
+
+
+def result_movies_schedule_list(tv_type_list, day="today"):
+    """
+    This combine all the movies in schedule for the different tv types present in the list, they are retrieved
+    concurrently.
+
+    :param tv_type_list: list of tv types
+    :param day: interested day, possible value (today, tomorrow, future)
     :return: return the JSON with all the schedule for current list
     """
     schedule_list = []
@@ -104,8 +655,8 @@ def result_movies_schedule_list(tv_type_list):
         logging.info("no tv type set")
         tv_type_list = ["free"]
 
-    for i in tv_type_list:
-        schedule_list = schedule_list + result_movies_schedule(i, "today")
+    for schedule in result_movies_schedules(tv_type_list, day):
+        schedule_list = schedule_list + schedule
 
     return schedule_list
 
@@ -1,10 +1,15 @@
 # coding=utf-8
+import hashlib
+import marshal
 import requests
 import logging
+import sys
+import threading
+import zlib
 from datetime import timedelta, datetime
 from flask import Flask, jsonify
 from werkzeug.exceptions import InternalServerError, default_exceptions
-from google.appengine.api import urlfetch
+from google.appengine.api import memcache, urlfetch
 
 
 TV_CHANNELS = {"Rai 1": 1, "Rai 2": 2, "Rai3": 3, "Rete 4": 4, "Canale 5": 5,  "Italia 1": 6, "La7": 7, "MTV": 8,
@@ -33,8 +38,30 @@ GENRES = ['Action', 'Adventure', 'Animation', 'Biography', 'Comedy', 'Crime', 'D
 #               'Fantasy', 'Film-Noir', 'History', 'Horror', 'Music', 'Musical', 'Mystery', 'Romance', 'Sci-Fi', 'Sport',
 #               'Thriller', 'War', 'Western']
 
+ROLES = ['actor', 'director', 'writer']
+
+TASTE_KINDS = ['artist', 'movie', 'genre']
+
 NUMBER_SUGGESTIONS = 3
 
+CHANNEL_NOT_FOUND = "NotFound"  # Number of the channels not in TV_CHANNELS
+
+PROPOSAL_BATCH_SIZE = 100  # Users whose proposal is computed by a task
+
+MAX_FETCH_THREADS = 3  # One for every tv type
+
+PAGE_CACHE_TIME = 3 * 86400  # Seconds the validators and the parsed content of a page are kept
+
+SCHEDULE_FIELDS = ("title", "originalTitle", "channel", "channelNumber", "time", "minutes", "movieUrl", "year",
+                   "director", "genres", "cast", "idIMDB")
+SCHEDULE_TABLES = ("channel", "channelNumber", "time", "year", "director", "genres")  # Values repeated in a schedule
+
+PROPOSAL_FIELDS = ("idIMDB", "originalTitle", "poster", "title", "channel", "channelNumber", "time", "runTimes",
+                   "simplePlot", "italianPlot")
+PROPOSAL_TABLES = ("channel", "channelNumber", "time")
+
+RECORDS_MAGIC = "PT4R1"  # Prefix of the records encoded by encode_records
+
 GENRE_WEIGHT = 0.15
 ACTOR_WEIGHT = 0.2
 DIRECTOR_WEIGHT = 0.12
@@ -73,21 +100,192 @@ def json_api(import_name, **kwargs):
     return app
 
 
-def get(url):
+def fetch(url, headers=None):
     """
-    Get the HTML page from URL.
+    Send a GET request.
     :param url: URL of the page to retrieve
     :type url: string
-    :return: HTML page
-    :rtype: string
+    :param headers: headers of the request
+    :type headers: dict
+    :return: response
+    :rtype: requests.Response
     """
     urlfetch.set_default_fetch_deadline(60)
     try:
-        response = requests.get(url)
+        return requests.get(url, headers=headers)
     except Exception as exception:
         raise InternalServerError(exception)
 
-    return response.text
+
+def get(url):
+    """
+    Get the HTML page from URL.
+    :param url: URL of the page to retrieve
+    :type url: string
+    :return: HTML page
+    :rtype: string
+    """
+    return fetch(url).text
+
+
+def get_parsed(url, parser, encode=None, decode=None):
+    """
+    Get the page from URL already parsed. The validators (ETag and Last-Modified) of the last response, the hash of
+    its body and what the parser returned are kept in memcache: the request is conditional and, if the page is not
+    modified or its body has the same hash, the parsed content is reused without parsing the page again.
+    :param url: URL of the page to retrieve
+    :type url: string
+    :param parser: function of the page that returns its content, it must not depend on anything else
+    :type parser: function
+    :param encode: function that encodes the content for memcache, None to keep it as it is
+    :type encode: function
+    :param decode: function that decodes the content encoded by encode
+    :type decode: function
+    :return: what the parser returns
+    """
+    cache_key = "page:" + parser.__name__ + ":" + hashlib.md5(url.encode('utf-8')).hexdigest()
+    cached = memcache.get(cache_key)
+
+    headers = {}
+    if cached is not None:
+        if cached["etag"] is not None:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["lastModified"] is not None:
+            headers["If-Modified-Since"] = cached["lastModified"]
+
+    response = fetch(url, headers)
+    if cached is not None and response.status_code == 304:
+        logging.info("Not modified: %s", url)
+        return decode(cached["content"]) if decode is not None else cached["content"]
+
+    content_hash = hashlib.md5(response.content).hexdigest()
+    if cached is not None and cached["hash"] == content_hash:
+        logging.info("Same content: %s", url)
+        content = decode(cached["content"]) if decode is not None else cached["content"]
+    else:
+        content = parser(response.text)
+
+    memcache.set(cache_key, {"etag": response.headers.get("ETag"), "lastModified": response.headers.get("Last-Modified"),
+                             "hash": content_hash, "content": encode(content) if encode is not None else content},
+                 PAGE_CACHE_TIME)
+    return content
+
+
+def concurrent_map(function, items, max_threads=MAX_FETCH_THREADS):
+    """
+    Apply the function to every item in threads, for blocking calls such as get. The threads end before it returns.
+    :param function: function of an item
+    :type function: function
+    :param items: items
+    :type items: list
+    :param max_threads: maximum number of threads
+    :type max_threads: int
+    :return: results, in the order of the items
+    :rtype: list
+    :raise Exception: the first exception raised by the function, with its traceback
+    """
+    if len(items) <= 1:
+        return [function(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    pending = list(reversed(list(enumerate(items))))
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if len(pending) == 0 or len(errors) > 0:
+                    return
+                i, item = pending.pop()
+            try:
+                results[i] = function(item)
+            except Exception:
+                with lock:
+                    errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=work) for _ in range(min(max_threads, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        error_type, error, traceback = errors[0]
+        raise error_type, error, traceback
+
+    return results
+
+
+def encode_records(records, fields, tables=()):
+    """
+    Encode a list of dicts, such as a schedule or a proposal, in a compact string for memcache and the datastore.
+    Every dict becomes a tuple of the values of the fields, in order, and the values of the fields in tables are
+    replaced by their index in a table of the distinct values, then everything is marshalled and compressed.
+    The keys not in fields are kept too, see decode_records.
+    :param records: dicts of strings, numbers and None
+    :type records: list of dict
+    :param fields: usual keys of the dicts
+    :type fields: tuple of string
+    :param tables: fields with values repeated among the dicts
+    :type tables: tuple of string
+    :return: encoded records
+    :rtype: string
+    """
+    interned = dict((field, {}) for field in tables)
+    all_fields = (1 << len(fields)) - 1
+    field_set = set(fields)
+
+    rows = []
+    for record in records:
+        row = []
+        present = 0
+        for bit, field in enumerate(fields):
+            if field not in record:
+                row.append(None)
+                continue
+
+            present |= 1 << bit
+            value = record[field]
+            if field in interned:
+                value = interned[field].setdefault(value, len(interned[field]))
+            row.append(value)
+
+        extra = dict((key, value) for key, value in record.iteritems() if key not in field_set)
+        row.append(present if present != all_fields else None)  # None if it has all the fields, as usual
+        row.append(extra if len(extra) > 0 else None)
+        rows.append(tuple(row))
+
+    tables = dict((field, sorted(values, key=values.get)) for field, values in interned.items())
+    return RECORDS_MAGIC + zlib.compress(marshal.dumps((tuple(fields), tables, rows), 2))
+
+
+def decode_records(data):
+    """
+    Decode the records encoded by encode_records, anything else is returned as it is (e.g. stored before the codec).
+    :param data: encoded records
+    :type data: string
+    :return: records
+    :rtype: list of dict
+    """
+    if not isinstance(data, str) or not data.startswith(RECORDS_MAGIC):
+        return data
+
+    fields, tables, rows = marshal.loads(zlib.decompress(data[len(RECORDS_MAGIC):]))
+    columns = [(bit, field, tables.get(field)) for bit, field in enumerate(fields)]
+
+    records = []
+    for row in rows:
+        present, extra = row[-2], row[-1]
+        record = {}
+        for bit, field, table in columns:
+            if present is None or present >> bit & 1:
+                record[field] = table[row[bit]] if table is not None else row[bit]
+        if extra is not None:
+            record.update(extra)
+        records.append(record)
+
+    return records
 
 
 def time_for_tomorrow():
@@ -148,7 +346,7 @@ def channel_number(channel_name):
     try:
         val = str(TV_CHANNELS[channel_name])
     except KeyError:
-        val = "NotFound"
+        val = CHANNEL_NOT_FOUND
 
     return val
 